@@ -5,10 +5,11 @@ pretrained model from the torchvision library. It includes functions to:
 - List image files directly from a ZIP file without extraction.
 - Apply model-specific preprocessing and transformations.
 - Extract embeddings using various models.
-- Save the resulting embeddings into a CSV file.
+- Stream the resulting embeddings batch by batch into a CSV, Parquet,
+  NPY or HDF5 file.
 Modules required:
 - argparse: For command-line argument parsing.
-- os, csv, zipfile: For file handling (ZIP file reading, CSV writing).
+- os, zipfile: For file handling (ZIP file reading).
 - inspect: For inspecting function signatures and models.
 - torch, torchvision: For loading and using pretrained models
 to extract embeddings.
@@ -17,11 +18,20 @@ and conversion.
 """
 
 import argparse
-import csv
+import copy
+import hashlib
 import inspect
+import json
 import logging
+import multiprocessing
 import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import time
 import zipfile
+from contextlib import ExitStack
 from inspect import signature
 
 import cv2
@@ -29,15 +39,19 @@ import numpy as np
 import torch
 import torchvision.models as models
 from PIL import Image
-from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
+from torch.utils.data import DataLoader, Dataset, Subset
 
-# Configure logging
+# Configure logging: everything to the log file, progress and warnings
+# also to stderr, where Galaxy shows them
+stderr_handler = logging.StreamHandler()
+stderr_handler.setLevel(logging.INFO)
 logging.basicConfig(
-    filename="/tmp/ludwig_embeddings.log",
-    filemode="a",
     format="%(asctime)s - %(levelname)s - %(message)s",
     level=logging.DEBUG,
+    handlers=[
+        logging.FileHandler("/tmp/ludwig_embeddings.log", mode="a"),
+        stderr_handler,
+    ],
 )
 
 # Create a cache directory in the current working directory
@@ -92,8 +106,54 @@ for model, settings in MODEL_DEFAULTS.items():
     if "normalize" not in settings:
         settings["normalize"] = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 
+# DataLoader defaults and autotuning
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_NUM_WORKERS = 1
+DEFAULT_PREFETCH_FACTOR = 2
+AUTOTUNE_BATCHES = 4  # timed batches per probed configuration, after one warm-up
+AUTOTUNE_MIN_GAIN = 1.05  # stop scaling up once throughput improves less
+AUTOTUNE_MAX_BATCH_SIZE = 256
+AUTOTUNE_MEMORY_FRACTION = 0.5  # default share of available memory for batches
+ACTIVATION_MEMORY_FACTOR = 16  # rough peak activations per input tensor byte
+
+# Reduced-precision inference
+PRECISIONS = ("float32", "bfloat16")
+DEFAULT_ACCURACY_CHECK_IMAGES = 64  # images compared against float32
+
+# INT8 quantization
+QUANTIZATION_METHODS = ("none", "auto", "dynamic", "static")
+LINEAR_HEAVY_MODELS = ("swin_", "vit_")  # prefixes quantized dynamically
+DEFAULT_CALIBRATION_IMAGES = 128
+
+# Inference engines
+ENGINES = ("eager", "compile", "torchscript", "onnx")
+ONNX_OPSET = 17
+
+# Preprocessing
+DRAFT_DECODE_MODES = ("RGB", "L")  # JPEG modes decoded at reduced scale
+PREPROCESSING_VERSION = 2  # part of embedding cache keys
+
+# Embedding outputs
+DEFAULT_FLOAT_PRECISION = 9  # significant digits; 9 round-trips float32
+OUTPUT_FORMATS = ("csv", "parquet", "npy", "h5")
+OUTPUT_DTYPES = ("float32", "float16")
+NPY_HEADER_LENGTH = 128  # fixed, so the final shape can be written in place
+H5_CHUNK_ROWS = 1024
+
+# Embedding cache
+CACHE_DATABASE = "embeddings.sqlite"
+DEFAULT_CACHE_MAX_GB = 10
+CACHE_QUERY_SIZE = 500  # keys per SQL query
+
+
+# Custom transform classes, on uint8 arrays of grayscale (H, W) or
+# color (H, W, C) images
+def to_grayscale(img):
+    if img.ndim == 3:
+        return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return img
+
 
-# Custom transform classes
 class CLAHETransform:
     def __init__(self, clip_limit=2.0, tile_grid_size=(8, 8)):
         self.clahe = cv2.createCLAHE(
@@ -102,9 +162,7 @@ class CLAHETransform:
         )
 
     def __call__(self, img):
-        img = np.array(img.convert("L"))
-        img = self.clahe.apply(img)
-        return Image.fromarray(img).convert("RGB")
+        return self.clahe.apply(to_grayscale(img))
 
 
 class CannyTransform:
@@ -113,36 +171,515 @@ class CannyTransform:
         self.threshold2 = threshold2
 
     def __call__(self, img):
-        img = np.array(img.convert("L"))
-        edges = cv2.Canny(img, self.threshold1, self.threshold2)
-        return Image.fromarray(edges).convert("RGB")
+        return cv2.Canny(to_grayscale(img), self.threshold1, self.threshold2)
 
 
 class RGBAtoRGBTransform:
+    """Composites RGBA images over a white background."""
+
     def __call__(self, img):
-        if img.mode == "RGBA":
-            background = Image.new("RGBA", img.size, (255, 255, 255, 255))
-            img = Image.alpha_composite(background, img).convert("RGB")
-        else:
-            img = img.convert("RGB")
+        if img.ndim < 3 or img.shape[2] != 4:
+            return img
+        alpha = img[:, :, 3:].astype(np.uint16)
+        rgb = img[:, :, :3] * alpha + 255 * (255 - alpha)
+        return ((rgb + 127) // 255).astype(np.uint8)
+
+
+def resize_image(img, size):
+    """Resizes a uint8 image array to (height, width), averaging pixel
+    areas when shrinking."""
+    height, width = size
+    if img.shape[:2] == (height, width):
         return img
+    shrinking = img.shape[0] > height or img.shape[1] > width
+    return cv2.resize(
+        img, (width, height),
+        interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+    )
+
+
+class SharedDecodeTransform:
+    """Decodes an image once and resizes it for each model preprocessing,
+    returning one uint8 tensor per preprocessing.
+
+    JPEG images are decoded at the smallest DCT scale that still covers
+    the largest resize, and the image transformation runs on NumPy
+    arrays. Grayscale images stay single-channel until
+    ``prepare_batch``; conversion to float and normalization are left to
+    it, on whole batches.
+    """
+
+    def __init__(self, decode_mode, array_transform, resizes):
+        self.decode_mode = decode_mode
+        self.array_transform = array_transform
+        self.resizes = resizes
+
+    def __call__(self, img):
+        if self.decode_mode in DRAFT_DECODE_MODES:
+            img.draft(self.decode_mode, (
+                max(width for _, width in self.resizes),
+                max(height for height, _ in self.resizes)
+            ))
+        img = np.asarray(img.convert(self.decode_mode))
+        if self.array_transform is not None:
+            img = self.array_transform(img)
+        return tuple(
+            torch.from_numpy(np.ascontiguousarray(resize_image(img, size)))
+            for size in self.resizes
+        )
+
+
+def prepare_batch(images, device, normalize=None):
+    """Converts a batch of uint8 (N, H, W) or (N, H, W, C) images to a
+    float (N, 3, H, W) tensor on the device, scaled to [0, 1] and
+    normalized with (mean, std) if given."""
+    images = images.to(device, non_blocking=True)
+    if images.dim() == 3:
+        images = images.unsqueeze(-1)
+    if images.shape[-1] == 1:
+        images = images.expand(-1, -1, -1, 3)
+    images = images.permute(0, 3, 1, 2).float().div_(255)
+    if normalize is not None:
+        mean, std = (
+            torch.tensor(values, device=device).view(1, -1, 1, 1)
+            for values in normalize
+        )
+        images = images.sub_(mean).div_(std)
+    return images.contiguous()
+
+
+class ModelInputTransform:
+    """Prepares one image as the float input tensor of a single model."""
+
+    def __init__(self, decode_transform, normalize):
+        self.decode_transform = decode_transform
+        self.normalize = normalize
+
+    def __call__(self, img):
+        images = self.decode_transform(img)[0].unsqueeze(0)
+        return prepare_batch(images, torch.device("cpu"), self.normalize)[0]
+
+
+class ImageDataset(Dataset):
+    """Images read from a ZIP file through one archive handle per process.
+
+    The archive and its name-to-ZipInfo index are opened lazily on first
+    access in each process, so DataLoader workers parse the central
+    directory once instead of once per image, and never share a forked
+    file handle with the parent.
+    """
+
+    def __init__(self, zip_file, file_list, transform=None):
+        self.zip_file = zip_file
+        self.file_list = file_list
+        self.transform = transform
+        self._zip_ref = None
+        self._zip_pid = None
+        self._members = None
+
+    def __len__(self):
+        return len(self.file_list)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_zip_ref=None, _zip_pid=None, _members=None)
+        return state
+
+    def _open_zip(self):
+        if self._zip_ref is None or self._zip_pid != os.getpid():
+            self._zip_ref = zipfile.ZipFile(self.zip_file, "r")
+            self._zip_pid = os.getpid()
+            self._members = {
+                info.filename: info for info in self._zip_ref.infolist()
+            }
+        return self._zip_ref
+
+    def close(self):
+        if self._zip_ref is not None and self._zip_pid == os.getpid():
+            self._zip_ref.close()
+        self._zip_ref = None
+        self._members = None
+
+    def __getitem__(self, idx):
+        zip_ref = self._open_zip()
+        name = self.file_list[idx]
+        with zip_ref.open(self._members[name]) as file:
+            try:
+                image = Image.open(file)
+                if self.transform:
+                    image = self.transform(image)
+                return image, idx
+            except Exception as e:
+                logging.warning("Skipping %s: %s", name, e)
+                return None, idx
+
+
+def collate_fn(batch):
+    """Stacks the images of a batch with their dataset indices,
+    dropping those that failed to load. Images prepared for several models
+    are stacked into one tensor per model preprocessing."""
+    batch = [item for item in batch if item[0] is not None]
+    if not batch:
+        return None, None
+    images, indices = zip(*batch)
+    if isinstance(images[0], tuple):
+        return tuple(torch.stack(group) for group in zip(*images)), indices
+    return torch.stack(images), indices
+
+
+def create_dataloader(dataset, batch_size, num_workers, prefetch_factor,
+                      device):
+    """Creates an ordered DataLoader over the dataset."""
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers else None,
+        shuffle=False,
+        pin_memory=device.type == "cuda",
+        collate_fn=collate_fn,
+    )
+
+
+def get_available_cpus():
+    """Returns the number of CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_available_memory():
+    """Returns the available physical memory in bytes."""
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def estimate_loader_memory(batch_size, num_workers, prefetch_factor,
+                           resizes):
+    """Estimates the memory held by uint8 batches in flight and by the
+    activations of their float inputs, with images resized to each of
+    ``resizes``."""
+    pixels = sum(height * width for height, width in resizes)
+    batch_bytes = batch_size * 3 * pixels
+    in_flight = max(1, num_workers * prefetch_factor) + 1
+    return batch_bytes * (in_flight + 4 * ACTIVATION_MEMORY_FACTOR)
+
+
+def measure_throughput(embed, dataset, device, batch_size, num_workers,
+                       prefetch_factor):
+    """Returns the images per second of extraction on the first images.
+
+    The first batch, which includes worker start-up, is not timed.
+    """
+    subset = Subset(
+        dataset, range(min(len(dataset), batch_size * (AUTOTUNE_BATCHES + 1)))
+    )
+    dataloader = create_dataloader(
+        subset, batch_size, num_workers, prefetch_factor, device
+    )
+    count = 0
+    start = None
+    for images, indices in dataloader:
+        if images is None:
+            continue
+        embed(images)
+        if start is None:
+            start = time.perf_counter()
+        else:
+            count += len(indices)
+    if not count:
+        return 0.0
+    return count / (time.perf_counter() - start)
+
+
+def autotune_loader(embed, dataset, device, batch_size, num_workers,
+                    prefetch_factor, resizes, memory_budget):
+    """Probes DataLoader settings on the first images of the dataset.
+
+    Worker count, then batch size, are doubled from the given values while
+    throughput improves and the estimated batch memory fits the budget.
+    Returns the fastest (batch_size, num_workers).
+    """
+    max_workers = get_available_cpus()
+
+    def probe(candidate_batch_size, candidate_workers):
+        memory = estimate_loader_memory(
+            candidate_batch_size, candidate_workers, prefetch_factor, resizes
+        )
+        if memory > memory_budget:
+            logging.info(
+                "Autotune: skipping batch size %d with %d workers, "
+                "needs about %d MB", candidate_batch_size,
+                candidate_workers, memory // 1024 ** 2
+            )
+            return 0.0
+        try:
+            rate = measure_throughput(
+                embed, dataset, device, candidate_batch_size,
+                candidate_workers, prefetch_factor
+            )
+        except RuntimeError as e:
+            logging.warning(
+                "Autotune: batch size %d with %d workers failed: %s",
+                candidate_batch_size, candidate_workers, e
+            )
+            return 0.0
+        logging.info(
+            "Autotune: batch size %d with %d workers: %.1f images/s",
+            candidate_batch_size, candidate_workers, rate
+        )
+        return rate
+
+    best = (batch_size, num_workers)
+    best_rate = probe(*best)
+    candidate_workers = max(1, num_workers)
+    while candidate_workers * 2 <= max_workers:
+        candidate_workers *= 2
+        rate = probe(best[0], candidate_workers)
+        if rate < best_rate * AUTOTUNE_MIN_GAIN:
+            break
+        best, best_rate = (best[0], candidate_workers), rate
+
+    candidate_batch_size = best[0]
+    max_batch_size = min(
+        AUTOTUNE_MAX_BATCH_SIZE, len(dataset) // (AUTOTUNE_BATCHES + 1)
+    )
+    while candidate_batch_size * 2 <= max_batch_size:
+        candidate_batch_size *= 2
+        rate = probe(candidate_batch_size, best[1])
+        if rate < best_rate * AUTOTUNE_MIN_GAIN:
+            break
+        best, best_rate = (candidate_batch_size, best[1]), rate
+
+    logging.info(
+        "Autotune: using batch size %d with %d workers (%.1f images/s)",
+        best[0], best[1], best_rate
+    )
+    return best
+
+
+def create_embed_function(model, device, precision="float32"):
+    """Returns a function that embeds a batch of images with the model.
+
+    With bfloat16 precision, the model and its inputs use the
+    channels_last memory format and run under bfloat16 autocast; the
+    embeddings are returned as float32.
+    """
+    if precision == "float32":
+        def embed(images):
+            return model(images.to(device))
+        return embed
+
+    model.to(memory_format=torch.channels_last)
+
+    def embed(images):
+        images = images.to(device).contiguous(memory_format=torch.channels_last)
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+            return model(images).float()
+    return embed
+
+
+def quantize_model(model, model_name, method, dataset, batch_size,
+                   calibration_images):
+    """Returns an INT8 copy of a float32 CPU model.
+
+    Dynamic quantization converts the Linear layers, which dominate
+    transformer backbones. Static post-training quantization traces the
+    model with torch.fx and calibrates activation ranges on the first
+    images of the dataset, which suits convolutional backbones; models
+    that cannot be traced fall back to dynamic quantization. ``auto``
+    picks dynamic quantization for ViT and Swin models and static
+    quantization otherwise.
+    """
+    if method == "auto":
+        method = "dynamic" if model_name.startswith(LINEAR_HEAVY_MODELS) \
+            else "static"
+
+    if method == "static":
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        subset = Subset(dataset, range(min(len(dataset), calibration_images)))
+        dataloader = create_dataloader(
+            subset, batch_size, 0, None, torch.device("cpu")
+        )
+        batches = [images for images, _ in dataloader if images is not None]
+        if batches:
+            try:
+                prepared = prepare_fx(
+                    copy.deepcopy(model),
+                    get_default_qconfig_mapping(torch.backends.quantized.engine),
+                    example_inputs=(batches[0],)
+                )
+                with torch.no_grad():
+                    for images in batches:
+                        prepared(images)
+                logging.info(
+                    "Calibrated static INT8 quantization on %d images",
+                    sum(len(images) for images in batches)
+                )
+                return convert_fx(prepared)
+            except Exception as e:
+                logging.warning(
+                    "Static quantization of %s failed (%s), "
+                    "using dynamic quantization", model_name, e
+                )
+        else:
+            logging.warning(
+                "No images to calibrate on, using dynamic quantization"
+            )
+
+    logging.info("Applying dynamic INT8 quantization to Linear layers")
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def describe_inference(precision, quantization):
+    """Returns a label for the numeric mode of inference."""
+    if quantization != "none":
+        return f"int8 ({quantization})"
+    return precision
+
+
+class OnnxRuntimeModel:
+    """Runs an exported ONNX graph with ONNX Runtime on the CPU,
+    called like the torch module it was exported from."""
+
+    def __init__(self, path):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, images):
+        outputs = self.session.run(None, {"images": images.cpu().numpy()})
+        return torch.from_numpy(outputs[0])
+
+
+def get_engine_artifact_path(artifact_dir, model_name, engine, resize):
+    """Returns where the exported graph of a model and input size is kept."""
+    versions = f"torch{torch.__version__}".replace("+", "_")
+    extension = "onnx" if engine == "onnx" else "pt"
+    return os.path.join(
+        artifact_dir,
+        f"{model_name}_{resize[0]}x{resize[1]}_{versions}.{extension}"
+    )
+
+
+def prepare_inference_engine(model, model_name, engine, resize, device,
+                             artifact_dir):
+    """Returns the model compiled or exported for the inference engine.
+
+    TorchScript and ONNX graphs are traced once per model, input size and
+    torch version and kept in ``artifact_dir``, so later runs on the same
+    node load them instead of tracing again. torch.compile keeps its
+    generated kernels under the same directory.
+    """
+    if engine == "eager":
+        return model
+    artifact_dir = artifact_dir or os.path.join(cache_dir, "engines")
+    os.makedirs(artifact_dir, exist_ok=True)
+    if engine == "compile":
+        os.environ.setdefault(
+            "TORCHINDUCTOR_CACHE_DIR", os.path.join(artifact_dir, "inductor")
+        )
+        return torch.compile(model)
+
+    path = get_engine_artifact_path(artifact_dir, model_name, engine, resize)
+    if os.path.exists(path):
+        logging.info("Reusing %s graph: %s", engine, path)
+    else:
+        example = torch.zeros(1, 3, *resize, device=device)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with torch.no_grad():
+            if engine == "torchscript":
+                torch.jit.save(torch.jit.trace(model, example), temp_path)
+            else:
+                torch.onnx.export(
+                    model, example, temp_path,
+                    input_names=["images"],
+                    output_names=["embeddings"],
+                    dynamic_axes={"images": {0: "batch"},
+                                  "embeddings": {0: "batch"}},
+                    opset_version=ONNX_OPSET
+                )
+        os.replace(temp_path, path)
+        logging.info("Saved %s graph: %s", engine, path)
+
+    if engine == "torchscript":
+        module = torch.jit.load(path, map_location=device).eval()
+        return torch.jit.optimize_for_inference(torch.jit.freeze(module))
+    return OnnxRuntimeModel(path)
+
+
+def compare_embeddings(reference, candidate):
+    """Summarizes how far (N, D) candidate embeddings are from a reference."""
+    reference = reference.reshape(len(reference), -1).astype(np.float64)
+    candidate = candidate.reshape(len(candidate), -1).astype(np.float64)
+    norms = (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    )
+    cosine = (reference * candidate).sum(axis=1) / np.maximum(norms, 1e-12)
+    return {
+        "images": len(reference),
+        "mean_cosine_similarity": float(cosine.mean()),
+        "min_cosine_similarity": float(cosine.min()),
+        "max_abs_difference": float(np.abs(reference - candidate).max()),
+    }
+
+
+def check_embedding_accuracy(reference_embed, embed, dataset, device,
+                             batch_size, sample_size):
+    """Compares embeddings of the first images of the dataset with those
+    of a float32 reference and returns the comparison."""
+    subset = Subset(dataset, range(min(len(dataset), sample_size)))
+    dataloader = create_dataloader(subset, batch_size, 0, None, device)
+    references, candidates = [], []
+    for images, _ in dataloader:
+        if images is None:
+            continue
+        references.append(reference_embed(images).float().cpu().numpy())
+        candidates.append(embed(images).float().cpu().numpy())
+    if not references:
+        return None
+    return compare_embeddings(
+        np.concatenate(references), np.concatenate(candidates)
+    )
 
 
 def get_image_files_from_zip(zip_file):
-    """Returns a list of image file names in the ZIP file."""
+    """Returns a list of image file names in the ZIP file.
+
+    Archives of NPY tile shards hold no images and are rejected rather
+    than producing empty embeddings."""
     try:
         with zipfile.ZipFile(zip_file, "r") as zip_ref:
-            file_list = [
-                f for f in zip_ref.namelist() if f.lower().endswith(
-                    (".png", ".jpg", ".jpeg", ".bmp", ".gif")
-                )
-            ]
-        return file_list
+            names = zip_ref.namelist()
     except zipfile.BadZipFile as exc:
         raise RuntimeError("Invalid ZIP file.") from exc
     except Exception as exc:
         raise RuntimeError("Error reading ZIP file.") from exc
 
+    file_list = [
+        f for f in names if f.lower().endswith(
+            (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+        )
+    ]
+    if not file_list:
+        if any(f.lower().endswith(".npy") for f in names):
+            raise ValueError(
+                "The ZIP file holds NPY tile shards, not images. "
+                "Tile the slides with PNG output to extract embeddings."
+            )
+        logging.warning("No image files found in the ZIP file.")
+    return file_list
+
 
 def load_model(model_name, device):
     """Loads a specified torchvision model and
@@ -173,164 +710,903 @@ def load_model(model_name, device):
     return model
 
 
-def write_csv(output_csv, list_embeddings, ludwig_format=False):
-    """Writes embeddings to a CSV file, optionally in Ludwig format."""
-    with open(output_csv, mode="w", encoding="utf-8", newline="") as csv_file:
-        csv_writer = csv.writer(csv_file)
-        if list_embeddings:
-            if ludwig_format:
-                header = ["sample_name", "embedding"]
-                formatted_embeddings = []
-                for embedding in list_embeddings:
-                    sample_name = embedding[0]
-                    vector = embedding[1:]
-                    embedding_str = " ".join(map(str, vector))
-                    formatted_embeddings.append([sample_name, embedding_str])
-                csv_writer.writerow(header)
-                csv_writer.writerows(formatted_embeddings)
-                logging.info("CSV created in Ludwig format")
-            else:
-                header = ["sample_name"] + [f"vector{i + 1}" for i in range(
-                    len(list_embeddings[0]) - 1
-                )]
-                csv_writer.writerow(header)
-                csv_writer.writerows(list_embeddings)
-                logging.info("CSV created")
+def quote_csv_field(value):
+    """Quotes a CSV field the way csv.writer does with minimal quoting."""
+    if any(char in value for char in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+class EmbeddingCSVWriter:
+    """Streams embeddings to a CSV file batch by batch.
+
+    The wide layout has one column per vector component; the Ludwig layout
+    holds the whole vector as one space-separated column. Each batch is
+    formatted in one pass with a precomputed row format, and nothing is
+    kept once it is written.
+    """
+
+    def __init__(self, output_csv, ludwig_format=False,
+                 float_precision=DEFAULT_FLOAT_PRECISION):
+        self.ludwig_format = ludwig_format
+        self.float_format = f"%.{float_precision}g"
+        self.row_format = None
+        self.count = 0
+        self.csv_file = open(output_csv, mode="w", encoding="utf-8",
+                             newline="")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_header(self, dimension):
+        if self.ludwig_format:
+            header = ["sample_name", "embedding"]
+            separator = " "
         else:
-            csv_writer.writerow(["sample_name"] if not ludwig_format
-                                else ["sample_name", "embedding"])
+            header = ["sample_name"] + get_vector_columns(dimension)
+            separator = ","
+        self.csv_file.write(",".join(header) + "\r\n")
+        self.row_format = (
+            "%s," + separator.join([self.float_format] * dimension) + "\r\n"
+        )
+
+    def write_batch(self, names, embeddings):
+        """Writes a (N, D) array of embeddings with their sample names."""
+        if self.row_format is None:
+            self._write_header(embeddings.shape[1])
+        self.csv_file.write("".join(
+            self.row_format % (quote_csv_field(name), *vector)
+            for name, vector in zip(names, embeddings.tolist())
+        ))
+        self.count += len(names)
+
+    def close(self):
+        if self.csv_file.closed:
+            return
+        if self.row_format is None:
+            self.csv_file.write(
+                "sample_name,embedding\r\n" if self.ludwig_format
+                else "sample_name\r\n"
+            )
             logging.info("No valid images found. Empty CSV created.")
+        else:
+            logging.info(
+                "CSV created%s with %d embeddings",
+                " in Ludwig format" if self.ludwig_format else "", self.count
+            )
+        self.csv_file.close()
+
+
+def get_vector_columns(dimension):
+    """Returns the column names of the components of a vector."""
+    return [f"vector{i + 1}" for i in range(dimension)]
+
+
+class EmbeddingParquetWriter:
+    """Streams embeddings to a Parquet file, one row group per batch.
+
+    Rows hold the sample_name followed by one column per vector component.
+    """
+
+    def __init__(self, output_path, dtype="float32"):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.pyarrow_parquet = pyarrow.parquet
+        self.output_path = output_path
+        self.dtype = np.dtype(dtype)
+        self.writer = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _schema(self, dimension):
+        value_type = self.pyarrow.from_numpy_dtype(self.dtype)
+        return self.pyarrow.schema(
+            [("sample_name", self.pyarrow.string())]
+            + [(column, value_type) for column in get_vector_columns(dimension)]
+        )
+
+    def write_batch(self, names, embeddings):
+        """Writes a (N, D) array of embeddings with their sample names."""
+        embeddings = embeddings.astype(self.dtype, copy=False)
+        if self.writer is None:
+            self.writer = self.pyarrow_parquet.ParquetWriter(
+                self.output_path, self._schema(embeddings.shape[1])
+            )
+        columns = [self.pyarrow.array(list(names), self.pyarrow.string())]
+        columns += [self.pyarrow.array(column) for column in embeddings.T]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+            columns, schema=self.writer.schema
+        ))
+        self.count += len(names)
+
+    def close(self):
+        if self.writer is None:
+            self.pyarrow_parquet.write_table(
+                self._schema(0).empty_table(), self.output_path
+            )
+            logging.info("No valid images found. Empty Parquet file created.")
+        elif self.writer:
+            self.writer.close()
+            logging.info("Parquet file created with %d embeddings", self.count)
+        self.writer = False
+
+
+class EmbeddingNPYWriter:
+    """Streams embeddings to a memory-mappable (N, D) NPY file.
+
+    Rows are appended as raw data after a fixed-length header that is
+    rewritten with the final shape on close. Sample names go to a one
+    column TSV index in row order.
+    """
+
+    def __init__(self, output_path, names_path, dtype="float32"):
+        self.dtype = np.dtype(dtype)
+        self.dimension = 0
+        self.count = 0
+        self.npy_file = open(output_path, "wb")
+        self.names_file = open(names_path, "w", encoding="utf-8")
+        self.names_file.write("sample_name\n")
+        self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_header(self):
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.count, self.dimension),
+        })
+        header = header.ljust(NPY_HEADER_LENGTH - 11) + "\n"
+        self.npy_file.seek(0)
+        self.npy_file.write(
+            b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header))
+            + header.encode("latin1")
+        )
+
+    def write_batch(self, names, embeddings):
+        """Writes a (N, D) array of embeddings with their sample names."""
+        self.dimension = embeddings.shape[1]
+        self.npy_file.seek(0, os.SEEK_END)
+        self.npy_file.write(
+            np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes()
+        )
+        self.names_file.write("".join(f"{name}\n" for name in names))
+        self.count += len(names)
+
+    def close(self):
+        if self.npy_file.closed:
+            return
+        self._write_header()
+        self.npy_file.close()
+        self.names_file.close()
+        logging.info("NPY file created with %d embeddings", self.count)
+
+
+class EmbeddingH5Writer:
+    """Streams embeddings to an HDF5 file.
+
+    The file holds an extendable (N, D) ``embeddings`` dataset and a
+    ``sample_name`` string dataset in the same row order.
+    """
+
+    def __init__(self, output_path, dtype="float32"):
+        import h5py
+
+        self.dtype = np.dtype(dtype)
+        self.h5_file = h5py.File(output_path, "w")
+        self.names = self.h5_file.create_dataset(
+            "sample_name", shape=(0,), maxshape=(None,),
+            dtype=h5py.string_dtype(), chunks=(H5_CHUNK_ROWS,)
+        )
+        self.embeddings = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_batch(self, names, embeddings):
+        """Writes a (N, D) array of embeddings with their sample names."""
+        dimension = embeddings.shape[1]
+        if self.embeddings is None:
+            self.embeddings = self.h5_file.create_dataset(
+                "embeddings", shape=(0, dimension),
+                maxshape=(None, dimension), dtype=self.dtype,
+                chunks=(H5_CHUNK_ROWS, dimension)
+            )
+        end = self.count + len(names)
+        self.names.resize((end,))
+        self.names[self.count:end] = list(names)
+        self.embeddings.resize((end, dimension))
+        self.embeddings[self.count:end] = embeddings.astype(self.dtype)
+        self.count = end
+
+    def close(self):
+        if not self.h5_file:
+            return
+        if self.embeddings is None:
+            self.h5_file.create_dataset(
+                "embeddings", shape=(0, 0), dtype=self.dtype
+            )
+        self.h5_file.close()
+        logging.info("HDF5 file created with %d embeddings", self.count)
+
+
+def create_embedding_writer(output_format, output_path, ludwig_format=False,
+                            float_precision=DEFAULT_FLOAT_PRECISION,
+                            dtype="float32", names_path=None):
+    """Creates the streaming writer for an output format."""
+    if output_format == "parquet":
+        return EmbeddingParquetWriter(output_path, dtype)
+    if output_format == "npy":
+        if names_path is None:
+            names_path = os.path.splitext(output_path)[0] + "_names.tsv"
+        return EmbeddingNPYWriter(output_path, names_path, dtype)
+    if output_format == "h5":
+        return EmbeddingH5Writer(output_path, dtype)
+    return EmbeddingCSVWriter(output_path, ludwig_format, float_precision)
+
+
+class EmbeddingCache:
+    """On-disk cache of embeddings keyed by image content and settings.
+
+    Vectors are stored as float32 blobs in a SQLite database under the
+    cache directory, keyed by a hash of the image bytes and of every
+    setting that changes the embedding. Reads refresh an entry's last use,
+    and on close the least recently used entries are evicted until the
+    stored vectors fit in ``max_bytes``.
+
+    Several jobs can share the database, relying on SQLite's file
+    locking, which is only dependable on local file systems: the cache
+    directory is expected on node-local storage. Entries can still be
+    evicted by another job between ``find`` and ``get``, so callers must
+    handle keys that ``get`` no longer returns.
+    """
+
+    def __init__(self, cache_dir, settings, max_bytes):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.settings_key = json.dumps(settings, sort_keys=True)
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(
+            os.path.join(cache_dir, CACHE_DATABASE), timeout=60
+        )
+        self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # Also moves caches written with a write-ahead log, which needs
+        # shared memory between all readers, back to the rollback journal
+        self.connection.execute("PRAGMA journal_mode = DELETE")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+            "ON embeddings (last_used)"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_key(self, content):
+        """Returns the cache key of an image's bytes under these settings."""
+        digest = hashlib.blake2b(content, digest_size=16)
+        digest.update(self.settings_key.encode())
+        return digest.hexdigest()
+
+    def _select(self, columns, keys):
+        for start in range(0, len(keys), CACHE_QUERY_SIZE):
+            chunk = keys[start:start + CACHE_QUERY_SIZE]
+            yield from self.connection.execute(
+                f"SELECT {columns} FROM embeddings "
+                f"WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            )
+
+    def _touch(self, keys):
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(time.time(), key) for key in keys]
+            )
+
+    def find(self, keys):
+        """Returns the set of keys that are cached, refreshing their last
+        use so that other jobs evict them last."""
+        found = {key for key, in self._select("key", sorted(set(keys)))}
+        self._touch(found)
+        return found
+
+    def get(self, keys):
+        """Returns the cached vectors of keys as a key to array dict."""
+        keys = sorted(set(keys))
+        vectors = {
+            key: np.frombuffer(vector, dtype=np.float32)
+            for key, vector in self._select("key, vector", keys)
+        }
+        self._touch(vectors)
+        return vectors
+
+    def put(self, keys, embeddings):
+        """Stores one (N, D) array of embeddings under N keys."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                [(key, vector.tobytes(), vector.nbytes, now)
+                 for key, vector in zip(keys, embeddings)]
+            )
+
+    def evict(self):
+        """Removes least recently used entries beyond the size bound."""
+        total, = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM embeddings"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.connection.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM embeddings WHERE key = ?", evicted
+            )
+        self.connection.execute("PRAGMA incremental_vacuum")
+        logging.info("Evicted %d cached embeddings", len(evicted))
+
+    def close(self):
+        if self.connection is not None:
+            self.evict()
+            self.connection.close()
+            self.connection = None
+
+
+def get_content_keys(zip_file, file_list, caches):
+    """Returns the cache keys of every image of the ZIP file, as one list
+    per cache, reading each image once."""
+    keys = [[] for _ in caches]
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        for name in file_list:
+            content = zip_ref.read(name)
+            for cache, cache_keys in zip(caches, keys):
+                cache_keys.append(cache.get_key(content))
+    return keys
+
+
+def merge_cached_embeddings(caches, keys, cached, computed_batches,
+                            batch_size, recompute):
+    """Yields (indices, embeddings) batches over all images in order, with
+    one (N, D) array per cache.
+
+    ``keys`` holds the image keys of each cache and ``cached`` the indices
+    of images cached in all of them. ``computed_batches`` yields ordered
+    batches, with indices into the keys, for the other images; they are
+    stored in the caches, and cached vectors are filled in around them.
+    Cached images evicted by another job in the meantime are passed to
+    ``recompute``, which yields batches like ``computed_batches``; once
+    one is found missing, all cached images not yet read are checked, so
+    that the models are loaded again only once per eviction.
+    """
+    recomputed = {}
+
+    def store(indices, embeddings):
+        for cache, cache_keys, cache_embeddings in zip(
+                caches, keys, embeddings):
+            cache.put([cache_keys[idx] for idx in indices], cache_embeddings)
+        return {
+            idx: [model_embeddings[row] for model_embeddings in embeddings]
+            for row, idx in enumerate(indices)
+        }
+
+    def recompute_evicted(start, computed):
+        remaining = [
+            idx for idx in sorted(cached)
+            if idx >= start and idx not in computed and idx not in recomputed
+        ]
+        found = [
+            cache.find([cache_keys[idx] for idx in remaining])
+            for cache, cache_keys in zip(caches, keys)
+        ]
+        evicted = [
+            idx for idx in remaining
+            if not all(cache_keys[idx] in cache_found
+                       for cache_keys, cache_found in zip(keys, found))
+        ]
+        logging.warning(
+            "%d cached embeddings were evicted by another job; "
+            "recomputing them", len(evicted)
+        )
+        for indices, embeddings in recompute(evicted):
+            recomputed.update(store(indices, embeddings))
+        missing = set(evicted) - set(recomputed)
+        if missing:
+            raise RuntimeError(
+                f"Could not recompute the evicted embeddings of "
+                f"{len(missing)} images"
+            )
+
+    def fill(start, end, computed):
+        for chunk_start in range(start, end, batch_size):
+            chunk = range(chunk_start, min(chunk_start + batch_size, end))
+            vectors = [
+                cache.get([
+                    cache_keys[idx] for idx in chunk
+                    if idx in cached and idx not in computed
+                    and idx not in recomputed
+                ])
+                for cache, cache_keys in zip(caches, keys)
+            ]
+            if any(
+                idx in cached and idx not in computed
+                and idx not in recomputed and not all(
+                    cache_keys[idx] in cache_vectors
+                    for cache_keys, cache_vectors in zip(keys, vectors)
+                )
+                for idx in chunk
+            ):
+                recompute_evicted(chunk_start, computed)
+            computed = {**computed, **{
+                idx: recomputed.pop(idx) for idx in chunk if idx in recomputed
+            }}
+            indices = [
+                idx for idx in chunk if idx in computed or idx in cached
+            ]
+            if indices:
+                yield indices, [
+                    np.stack([
+                        computed[idx][position] if idx in computed
+                        else cache_vectors[cache_keys[idx]]
+                        for idx in indices
+                    ])
+                    for position, (cache_keys, cache_vectors)
+                    in enumerate(zip(keys, vectors))
+                ]
+
+    position = 0
+    for indices, embeddings in computed_batches:
+        computed = store(indices, embeddings)
+        yield from fill(position, indices[-1] + 1, computed)
+        position = indices[-1] + 1
+    yield from fill(position, len(keys[0]) if keys else 0, {})
+
+
+def write_accuracy_report(output_path, mode, reports):
+    """Logs embedding accuracy comparisons, given as a model name to
+    comparison dict, and writes them as JSON."""
+    for model_name, report in reports.items():
+        if report is None:
+            logging.warning(
+                "No images to check %s %s embeddings against",
+                model_name, mode
+            )
+        else:
+            logging.info(
+                "%s %s embeddings vs float32 on %d images: mean cosine "
+                "similarity %.5f, min %.5f", model_name, mode,
+                report["images"], report["mean_cosine_similarity"],
+                report["min_cosine_similarity"]
+            )
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as report_file:
+            json.dump({
+                "mode": mode,
+                "models": {
+                    model_name: report or {"images": 0}
+                    for model_name, report in reports.items()
+                },
+            }, report_file, indent=2)
+
+
+def create_initial_transform(transform_type):
+    """Returns the decode mode and the array transformation applied before
+    model preprocessing."""
+    if transform_type == "grayscale":
+        return "L", None
+    if transform_type == "clahe":
+        return "L", CLAHETransform()
+    if transform_type == "edges":
+        return "L", CannyTransform()
+    if transform_type == "rgba_to_rgb":
+        return "RGBA", RGBAtoRGBTransform()
+    return "RGB", None
+
+
+def get_model_preprocessing(model_name, apply_normalization):
+    """Returns the (resize, normalize) preprocessing of a model, with
+    normalize None when normalization is not applied."""
+    model_settings = MODEL_DEFAULTS.get(model_name, MODEL_DEFAULTS["default"])
+    normalize = None
+    if apply_normalization:
+        mean, std = model_settings["normalize"]
+        normalize = (tuple(mean), tuple(std))
+    return tuple(model_settings["resize"]), normalize
 
 
 def extract_embeddings(
-        model_name,
+        model_names,
         apply_normalization,
         zip_file,
         file_list,
-        transform_type="rgb"):
-    """Extracts embeddings from images
-    using batch processing or sequential fallback."""
+        transform_type="rgb",
+        batch_size=DEFAULT_BATCH_SIZE,
+        num_workers=DEFAULT_NUM_WORKERS,
+        prefetch_factor=DEFAULT_PREFETCH_FACTOR,
+        num_threads=None,
+        autotune=False,
+        memory_budget=None,
+        precision="float32",
+        accuracy_check_images=DEFAULT_ACCURACY_CHECK_IMAGES,
+        accuracy_report=None,
+        quantization="none",
+        calibration_images=DEFAULT_CALIBRATION_IMAGES,
+        engine="eager",
+        engine_cache_dir=None):
+    """Extracts embeddings from images with one or more models using batch
+    processing or sequential fallback, yielding (indices, embeddings) per
+    batch, with indices into file_list of the images that could be read
+    and one (N, D) array per model.
+
+    Each image is decoded and transformed once, then resized for each
+    model by the DataLoader processes; batches are converted to float and
+    normalized on the inference device. Models with the same preprocessing
+    share one tensor. If the DataLoader fails, the sequential fallback resumes
+    after the last complete batch. With reduced precision or quantized
+    models, embeddings of the first images are compared with float32 ones
+    and the comparisons are logged and written to accuracy_report, if
+    given."""
 
+    if num_threads:
+        torch.set_num_threads(num_threads)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = load_model(model_name, device)
-    model_settings = MODEL_DEFAULTS.get(model_name, MODEL_DEFAULTS["default"])
-    resize = model_settings["resize"]
-    normalize = model_settings.get("normalize", (
-        [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
-    ))
+    if quantization != "none" or engine == "onnx":
+        # Quantized kernels and ONNX Runtime only run on the CPU
+        device = torch.device("cpu")
 
-    # Define transform pipeline
-    if transform_type == "grayscale":
-        initial_transform = transforms.Grayscale(num_output_channels=3)
-    elif transform_type == "clahe":
-        initial_transform = CLAHETransform()
-    elif transform_type == "edges":
-        initial_transform = CannyTransform()
-    elif transform_type == "rgba_to_rgb":
-        initial_transform = RGBAtoRGBTransform()
-    else:
-        initial_transform = transforms.Lambda(lambda x: x.convert("RGB"))
+    decode_mode, array_transform = create_initial_transform(transform_type)
+    preprocessings = []
+    model_groups = []
+    for model_name in model_names:
+        preprocessing = get_model_preprocessing(model_name, apply_normalization)
+        if preprocessing not in preprocessings:
+            preprocessings.append(preprocessing)
+        model_groups.append(preprocessings.index(preprocessing))
+    resizes = [resize for resize, _ in preprocessings]
 
-    transform_list = [initial_transform,
-                      transforms.Resize(resize),
-                      transforms.ToTensor()]
-    if apply_normalization:
-        transform_list.append(transforms.Normalize(mean=normalize[0],
-                                                   std=normalize[1]))
-    transform = transforms.Compose(transform_list)
-
-    class ImageDataset(Dataset):
-        def __init__(self, zip_file, file_list, transform=None):
-            self.zip_file = zip_file
-            self.file_list = file_list
-            self.transform = transform
-
-        def __len__(self):
-            return len(self.file_list)
-
-        def __getitem__(self, idx):
-            with zipfile.ZipFile(self.zip_file, "r") as zip_ref:
-                with zip_ref.open(self.file_list[idx]) as file:
-                    try:
-                        image = Image.open(file)
-                        if self.transform:
-                            image = self.transform(image)
-                        return image, os.path.basename(self.file_list[idx])
-                    except Exception as e:
-                        logging.warning(
-                            "Skipping %s: %s", self.file_list[idx], e
-                        )
-                        return None, os.path.basename(self.file_list[idx])
-
-    # Custom collate function
-    def collate_fn(batch):
-        batch = [item for item in batch if item[0] is not None]
-        if not batch:
-            return None, None
-        images, names = zip(*batch)
-        return torch.stack(images), names
-
-    list_embeddings = []
+    mode = describe_inference(precision, quantization)
+    embed_functions = []
+    reports = {}
+    for model_name, group in zip(model_names, model_groups):
+        # Calibration and the accuracy check only read the first images,
+        # through a dataset that prepares them for this model alone
+        resize, normalize = preprocessings[group]
+        model_dataset = ImageDataset(
+            zip_file, file_list, transform=ModelInputTransform(
+                SharedDecodeTransform(decode_mode, array_transform, [resize]),
+                normalize
+            )
+        )
+        model = load_model(model_name, device)
+        reference_model = model
+        if quantization != "none":
+            model = quantize_model(
+                model, model_name, quantization, model_dataset, batch_size,
+                calibration_images
+            )
+        model = prepare_inference_engine(
+            model, model_name, engine, resize, device, engine_cache_dir
+        )
+        embed = create_embed_function(model, device, precision)
+        if mode != "float32" and accuracy_check_images:
+            with torch.inference_mode():
+                reports[model_name] = check_embedding_accuracy(
+                    create_embed_function(reference_model, device), embed,
+                    model_dataset, device, batch_size, accuracy_check_images
+                )
+        model_dataset.close()
+        embed_functions.append(embed)
+    if reports:
+        write_accuracy_report(accuracy_report, mode, reports)
+
+    def embed_all(images):
+        batches = [
+            prepare_batch(group_images, device, normalize)
+            for group_images, (_, normalize) in zip(images, preprocessings)
+        ]
+        return [
+            embed(batches[group])
+            for embed, group in zip(embed_functions, model_groups)
+        ]
+
+    processed = 0
+    dataset = ImageDataset(
+        zip_file, file_list,
+        transform=SharedDecodeTransform(decode_mode, array_transform, resizes)
+    )
     with torch.inference_mode():
         try:
-            # Try DataLoader with reduced resource usage
-            dataset = ImageDataset(zip_file, file_list, transform=transform)
-            dataloader = DataLoader(
-                dataset,
-                batch_size=16,  # Reduced for lower memory usage
-                num_workers=1,  # Reduced to minimize shared memory
-                shuffle=False,
-                pin_memory=True if device == "cuda" else False,
-                collate_fn=collate_fn,
+            if autotune:
+                if memory_budget is None:
+                    memory_budget = (
+                        get_available_memory() * AUTOTUNE_MEMORY_FRACTION
+                    )
+                batch_size, num_workers = autotune_loader(
+                    embed_all, dataset, device, batch_size, num_workers,
+                    prefetch_factor, resizes, memory_budget
+                )
+            dataloader = create_dataloader(
+                dataset, batch_size, num_workers, prefetch_factor, device
             )
-            for images, names in dataloader:
-                if images is None:
-                    continue
-                images = images.to(device)
-                embeddings = model(images).cpu().numpy()
-                for name, embedding in zip(names, embeddings):
-                    list_embeddings.append([name] + embedding.tolist())
+            for images, indices in dataloader:
+                if images is not None:
+                    yield list(indices), [
+                        embeddings.cpu().numpy().reshape(len(indices), -1)
+                        for embeddings in embed_all(images)
+                    ]
+                # Counted once embedded, so that a batch the model fails
+                # on is retried by the sequential fallback
+                processed = min(processed + batch_size, len(dataset))
         except RuntimeError as e:
             logging.warning(
                 f"DataLoader failed: {e}. \
                 Falling back to sequential processing."
             )
             # Fallback to sequential processing
-            for file in file_list:
-                with zipfile.ZipFile(zip_file, "r") as zip_ref:
-                    with zip_ref.open(file) as img_file:
+            for idx in range(processed, len(dataset)):
+                images, _ = dataset[idx]
+                if images is None:
+                    continue
+                try:
+                    embeddings = embed_all(
+                        [image.unsqueeze(0) for image in images]
+                    )
+                except Exception as e:
+                    logging.warning("Skipping %s: %s", file_list[idx], e)
+                    continue
+                yield [idx], [
+                    model_embeddings.cpu().numpy().reshape(1, -1)
+                    for model_embeddings in embeddings
+                ]
+        finally:
+            dataset.close()
+
+
+def extract_shard(shard_path, cpus, model_names, apply_normalization,
+                  zip_file, file_list, transform_type, extract_kwargs):
+    """Extracts the embeddings of one shard of the images in a process
+    pinned to ``cpus``, pickling its batches to shard_path."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    extract_kwargs["num_threads"] = (
+        extract_kwargs.get("num_threads") or len(cpus)
+    )
+    with open(shard_path, "wb") as shard_file:
+        for batch in extract_embeddings(
+                model_names, apply_normalization, zip_file, file_list,
+                transform_type, **extract_kwargs):
+            pickle.dump(batch, shard_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def extract_sharded_embeddings(shards, model_names, apply_normalization,
+                               zip_file, file_list, transform_type="rgb",
+                               **extract_kwargs):
+    """Extracts embeddings in several processes, yielding batches in file
+    order like ``extract_embeddings``.
+
+    Each shard process gets a contiguous slice of file_list, its own
+    models, and a block of the available CPUs, with as many torch threads
+    as CPUs unless num_threads is given; DataLoader workers and the
+    autotune memory budget are divided among the shards. Partial outputs are kept in a temporary directory
+    and read back in shard order. Only the first shard checks accuracy.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    shards = max(1, min(shards, len(cpus), len(file_list)))
+    bounds = np.linspace(0, len(file_list), shards + 1).astype(int)
+    cpu_blocks = np.array_split(cpus, shards)
+    num_workers = extract_kwargs.get("num_workers", DEFAULT_NUM_WORKERS)
+    extract_kwargs["num_workers"] = num_workers and max(
+        1, num_workers // shards
+    )
+    if extract_kwargs.get("autotune"):
+        memory_budget = extract_kwargs.get("memory_budget") or (
+            get_available_memory() * AUTOTUNE_MEMORY_FRACTION
+        )
+        extract_kwargs["memory_budget"] = memory_budget / shards
+    logging.info("Extracting embeddings in %d shards", shards)
+
+    # Shards are spawned rather than forked, so that no torch or OpenMP
+    # state is inherited from this process
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(
+            prefix="embedding_shards_", dir=os.getcwd()) as shard_dir:
+        processes = []
+        try:
+            for shard in range(shards):
+                start, end = bounds[shard], bounds[shard + 1]
+                shard_kwargs = dict(extract_kwargs)
+                if shard:
+                    shard_kwargs.update(
+                        accuracy_check_images=0, accuracy_report=None
+                    )
+                shard_path = os.path.join(shard_dir, f"shard{shard}.pkl")
+                process = context.Process(target=extract_shard, args=(
+                    shard_path, [int(cpu) for cpu in cpu_blocks[shard]],
+                    model_names, apply_normalization, zip_file,
+                    file_list[start:end], transform_type, shard_kwargs
+                ))
+                process.start()
+                processes.append((process, shard_path, start))
+
+            for shard, (process, shard_path, start) in enumerate(processes):
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError(
+                        f"Extraction shard {shard} failed "
+                        f"with exit code {process.exitcode}"
+                    )
+                with open(shard_path, "rb") as shard_file:
+                    while True:
                         try:
-                            image = Image.open(img_file)
-                            image = transform(image)
-                            input_tensor = image.unsqueeze(0).to(device)
-                            embedding = model(
-                                input_tensor
-                            ).squeeze().cpu().numpy()
-                            list_embeddings.append(
-                                [os.path.basename(file)] + embedding.tolist()
-                            )
-                        except Exception as e:
-                            logging.warning("Skipping %s: %s", file, e)
-
-    return list_embeddings
-
-
-def main(zip_file, output_csv, model_name, apply_normalization=False,
-         transform_type="rgb", ludwig_format=False):
+                            indices, embeddings = pickle.load(shard_file)
+                        except EOFError:
+                            break
+                        yield [start + idx for idx in indices], embeddings
+                os.remove(shard_path)
+        finally:
+            for process, _, _ in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+
+def main(zip_file, output_paths, model_names, apply_normalization=False,
+         transform_type="rgb", ludwig_format=False,
+         batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS,
+         prefetch_factor=DEFAULT_PREFETCH_FACTOR, num_threads=None,
+         autotune=False, memory_budget=None,
+         float_precision=DEFAULT_FLOAT_PRECISION, output_format="csv",
+         dtype="float32", names_paths=None, cache_dir=None,
+         cache_max_bytes=DEFAULT_CACHE_MAX_GB * 1024 ** 3,
+         precision="float32",
+         accuracy_check_images=DEFAULT_ACCURACY_CHECK_IMAGES,
+         accuracy_report=None, quantization="none",
+         calibration_images=DEFAULT_CALIBRATION_IMAGES, engine="eager",
+         engine_cache_dir=None, shards=1):
     """Main entry point for processing the zip file and
-    extracting embeddings."""
+    extracting embeddings.
+
+    With one output path, the embeddings of all models are concatenated
+    in model order; otherwise each model is written to its own path.
+    ``names_paths`` gives the sample name index of each NPY output."""
     file_list = get_image_files_from_zip(zip_file)
     logging.info("Image files listed from ZIP")
 
-    list_embeddings = extract_embeddings(
-        model_name,
-        apply_normalization,
-        zip_file,
-        file_list,
-        transform_type
-    )
+    with ExitStack() as stack:
+        pending = list(range(len(file_list)))
+        if cache_dir:
+            caches = [
+                stack.enter_context(EmbeddingCache(cache_dir, {
+                    "model_name": model_name,
+                    "transform_type": transform_type,
+                    "normalize": apply_normalization,
+                    "resize": MODEL_DEFAULTS.get(
+                        model_name, MODEL_DEFAULTS["default"]
+                    )["resize"],
+                    "precision": precision,
+                    "quantization": quantization,
+                    "engine": engine,
+                    "preprocessing": PREPROCESSING_VERSION,
+                }, cache_max_bytes))
+                for model_name in model_names
+            ]
+            keys = get_content_keys(zip_file, file_list, caches)
+            cached_keys = [
+                cache.find(cache_keys)
+                for cache, cache_keys in zip(caches, keys)
+            ]
+            pending = [
+                idx for idx in range(len(file_list))
+                if any(cache_keys[idx] not in found
+                       for cache_keys, found in zip(keys, cached_keys))
+            ]
+            logging.info(
+                "%d of %d images found in the embedding cache",
+                len(file_list) - len(pending), len(file_list)
+            )
+
+        batches = iter(())
+        if not pending and accuracy_report:
+            write_accuracy_report(
+                accuracy_report, describe_inference(precision, quantization),
+                dict.fromkeys(model_names)
+            )
+        extract_kwargs = dict(
+            batch_size=batch_size,
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor,
+            num_threads=num_threads,
+            autotune=autotune,
+            memory_budget=memory_budget,
+            precision=precision,
+            accuracy_check_images=accuracy_check_images,
+            accuracy_report=accuracy_report,
+            quantization=quantization,
+            calibration_images=calibration_images,
+            engine=engine,
+            engine_cache_dir=engine_cache_dir
+        )
+        if pending:
+            pending_files = [file_list[idx] for idx in pending]
+            if shards > 1:
+                extracted = extract_sharded_embeddings(
+                    shards, model_names, apply_normalization, zip_file,
+                    pending_files, transform_type, **extract_kwargs
+                )
+            else:
+                extracted = extract_embeddings(
+                    model_names, apply_normalization, zip_file,
+                    pending_files, transform_type, **extract_kwargs
+                )
+            batches = (
+                ([pending[idx] for idx in indices], embeddings)
+                for indices, embeddings in extracted
+            )
+        if cache_dir:
+            def recompute(evicted):
+                extracted = extract_embeddings(
+                    model_names, apply_normalization, zip_file,
+                    [file_list[idx] for idx in evicted], transform_type,
+                    **dict(extract_kwargs, accuracy_check_images=0,
+                           accuracy_report=None)
+                )
+                for indices, embeddings in extracted:
+                    yield [evicted[idx] for idx in indices], embeddings
+
+            batches = merge_cached_embeddings(
+                caches, keys, set(range(len(file_list))) - set(pending),
+                batches, batch_size, recompute
+            )
+
+        writers = [
+            stack.enter_context(create_embedding_writer(
+                output_format, output_path, ludwig_format, float_precision,
+                dtype, names_path
+            ))
+            for output_path, names_path in zip(
+                output_paths, names_paths or [None] * len(output_paths)
+            )
+        ]
+        for indices, embeddings in batches:
+            names = [os.path.basename(file_list[idx]) for idx in indices]
+            if len(writers) == 1 and len(embeddings) > 1:
+                embeddings = [np.concatenate(embeddings, axis=1)]
+            for writer, model_embeddings in zip(writers, embeddings):
+                writer.write_batch(names, model_embeddings)
     logging.info("Embeddings extracted")
-    write_csv(output_csv, list_embeddings, ludwig_format)
 
 
 if __name__ == "__main__":
@@ -343,8 +1619,10 @@ if __name__ == "__main__":
     parser.add_argument(
         "--model_name",
         required=True,
+        nargs="+",
         choices=AVAILABLE_MODELS.keys(),
-        help="Model for embedding extraction."
+        help="Models for embedding extraction; several models share one "
+             "pass over the images."
     )
     parser.add_argument(
         "--normalize",
@@ -358,21 +1636,193 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--output_csv",
+        "--output",
+        dest="output",
         required=True,
-        help="Path to the output CSV file"
+        nargs="+",
+        help="Path to the output embeddings file, with the embeddings of "
+             "several models concatenated, or one path per model."
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Embeddings file format: CSV, Parquet, a memory-mappable NPY "
+             "matrix with a sample name index, or HDF5."
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=OUTPUT_DTYPES,
+        default="float32",
+        help="Value type of Parquet, NPY and HDF5 embeddings."
+    )
+    parser.add_argument(
+        "--output_names",
+        nargs="+",
+        help="Sample name index of each NPY output "
+             "(default: <output>_names.tsv)."
     )
     parser.add_argument(
         "--ludwig_format",
         action="store_true",
         help="Prepare CSV file in Ludwig input format"
     )
+    parser.add_argument(
+        "--float_precision",
+        type=int,
+        default=DEFAULT_FLOAT_PRECISION,
+        help="Significant digits written per embedding value."
+    )
+    parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default="float32",
+        help="Inference precision; bfloat16 runs the model under autocast "
+             "with channels_last inputs."
+    )
+    parser.add_argument(
+        "--accuracy_check_images",
+        type=int,
+        default=DEFAULT_ACCURACY_CHECK_IMAGES,
+        help="Images whose reduced-precision or quantized embeddings are "
+             "compared with float32 ones (0 to skip the check)."
+    )
+    parser.add_argument(
+        "--accuracy_report",
+        help="Optional JSON file for the reduced-precision or quantized "
+             "embedding accuracy check."
+    )
+    parser.add_argument(
+        "--quantization",
+        choices=QUANTIZATION_METHODS,
+        default="none",
+        help="INT8 CPU inference: dynamic quantization of Linear layers, "
+             "static quantization calibrated on the first images, or auto "
+             "(dynamic for ViT and Swin, static otherwise)."
+    )
+    parser.add_argument(
+        "--calibration_images",
+        type=int,
+        default=DEFAULT_CALIBRATION_IMAGES,
+        help="Images used to calibrate static quantization."
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="eager",
+        help="Inference engine: eager PyTorch, torch.compile, a traced "
+             "TorchScript graph, or an exported ONNX graph run with ONNX "
+             "Runtime on the CPU."
+    )
+    parser.add_argument(
+        "--engine_cache_dir",
+        default=os.path.join(cache_dir, "engines"),
+        help="Directory where compiled and exported graphs are kept "
+             "for reuse."
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of embeddings cached by image content and "
+             "extraction settings; cached images are not run again."
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        type=float,
+        default=DEFAULT_CACHE_MAX_GB,
+        help="Size bound of the embedding cache; least recently used "
+             "embeddings are evicted beyond it."
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of images per inference batch."
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=DEFAULT_NUM_WORKERS,
+        help="Number of DataLoader processes decoding images."
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=DEFAULT_PREFETCH_FACTOR,
+        help="Batches loaded in advance by each DataLoader process."
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        help="Number of torch intra-op threads (default: torch's choice)."
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of processes extracting contiguous slices of the "
+             "images, each pinned to its own block of CPUs with its own "
+             "model copy; --num_workers is divided among them."
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Probe worker counts and batch sizes on the first images "
+             "and use the fastest."
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        help="Memory in GB that autotuned batches may use "
+             "(default: half of the available memory)."
+    )
 
     args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if len(set(args.model_name)) != len(args.model_name):
+        parser.error("--model_name lists a model more than once")
+    if len(args.output) not in (1, len(args.model_name)):
+        parser.error("--output takes one path, or one path per model")
+    if args.output_names and len(args.output_names) != len(args.output):
+        parser.error("--output_names takes one path per output")
+    if args.output_format == "csv" and args.dtype != "float32":
+        parser.error("--dtype applies to binary output formats only")
+    if args.quantization != "none" and args.precision != "float32":
+        parser.error("--quantization cannot be combined with --precision")
+    if args.engine in ("torchscript", "onnx") and (
+            args.precision != "float32" or args.quantization != "none"):
+        parser.error(
+            f"--engine {args.engine} runs float32 models only"
+        )
+    if args.engine == "compile" and args.quantization != "none":
+        parser.error("--engine compile cannot run quantized models")
     main(
         args.zip_file,
-        args.output_csv,
+        args.output,
         args.model_name,
         args.normalize,
         args.transform_type,
-        args.ludwig_format
+        args.ludwig_format,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        num_threads=args.num_threads,
+        autotune=args.autotune,
+        memory_budget=(
+            args.memory_budget * 1024 ** 3 if args.memory_budget else None
+        ),
+        float_precision=args.float_precision,
+        output_format=args.output_format,
+        dtype=args.dtype,
+        names_paths=args.output_names,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=args.cache_max_gb * 1024 ** 3,
+        precision=args.precision,
+        accuracy_check_images=args.accuracy_check_images,
+        accuracy_report=args.accuracy_report,
+        quantization=args.quantization,
+        calibration_images=args.calibration_images,
+        engine=args.engine,
+        engine_cache_dir=args.engine_cache_dir,
+        shards=args.shards
     )
@@ -0,0 +1,422 @@
+"""
+Benchmarks for the galaxy-tiler tool.
+
+Subcommands:
+- archive: tile a slide once, then time archiving its tiles with every
+  ``--zip_compression`` mode and report archive time against archive size.
+- tiling: run ``tiling_pyhist.py`` end to end with each engine and a range
+  of worker counts, on the test slide and on synthetic pyramidal TIFFs, and
+  report tiles per second, seconds per slide, peak resident memory of the
+  whole process tree, and speedup over the smallest worker count.
+
+Synthetic slides are written with a minimal tiled TIFF writer (deflate
+tiles, one directory per pyramid level) that OpenSlide reads as a generic
+tiled TIFF, so no extra imaging dependency is needed.
+
+Results are printed as JSON (one record per measurement) and optionally
+written to ``--output``.
+
+Usage:
+  python benchmark_tiler.py archive --slide test-data/CMU-1-Small-Region.svs
+    [--downsample 1] [--repeats 3] [--output archive.json]
+  python benchmark_tiler.py tiling [--slide test-data/CMU-1-Small-Region.svs]
+    [--synthetic 20000x15000] [--engines pyhist,openslide] [--workers 1,2,4]
+    [--copies 4] [--downsample 8] [--repeats 1] [--output tiling.json]
+"""
+
+import argparse
+import json
+import logging
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from pathlib import Path
+from typing import BinaryIO, List, Tuple
+
+import numpy as np
+import openslide
+import psutil
+import tiling_pyhist
+
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_DEFLATE = 8
+SYNTHETIC_TILE_SIZE = 256
+SYNTHETIC_LEVEL_DOWNSAMPLE = 4
+SYNTHETIC_MIN_LEVEL_SIZE = 1024  # smallest pyramid level side
+SYNTHETIC_LAYOUT_SCALE = 128  # level-0 pixels per cell of the tissue layout
+RSS_POLL_SECONDS = 0.05
+
+
+def tile_slide(slide_path: Path, output_dir: Path, downsample: int) -> Path:
+    """Tile a slide with the native engine at the given downsample."""
+    config = tiling_pyhist.build_pyhist_config(slide_path, output_dir)
+    config["output_downsample"] = downsample
+    tile_dir = output_dir / f"{slide_path.stem}_tiles"
+    tile_dir.mkdir(parents=True, exist_ok=True)
+    with openslide.OpenSlide(str(slide_path)) as slide:
+        tiles = tiling_pyhist.plan_tissue_tiles(slide, config)
+    settings = {
+        "output_format": "png",
+        "shard_size": tiling_pyhist.DEFAULT_SHARD_SIZE,
+        "quality_thresholds": None,
+        "read_threads": tiling_pyhist.DEFAULT_READ_THREADS,
+    }
+    tiling_pyhist.extract_tile_band((slide_path, tile_dir, config, settings, 0, tiles))
+    return tile_dir
+
+
+def benchmark_archive(args: argparse.Namespace) -> List[dict]:
+    """Time archiving of one slide's tiles in every ZIP compression mode."""
+    slide_path = Path(args.slide)
+    records = []
+    with tempfile.TemporaryDirectory(prefix="tiler_bench_") as temp_dir_path:
+        temp_dir = Path(temp_dir_path)
+        tile_dir = tile_slide(slide_path, temp_dir / "tiles", args.downsample)
+        tile_count = len(list(tile_dir.glob(f"*.{tiling_pyhist.TILE_FORMAT}")))
+        tile_bytes = sum(tile.stat().st_size for tile in tile_dir.iterdir())
+
+        for mode, compression in tiling_pyhist.ZIP_COMPRESSION_MODES.items():
+            for repeat in range(args.repeats):
+                work_dir = temp_dir / f"{mode}_{repeat}"
+                shutil.copytree(tile_dir, work_dir)
+                zip_path = temp_dir / f"{mode}_{repeat}.zip"
+
+                start = time.perf_counter()
+                if mode == "parallel":
+                    tiling_pyhist.precompress_tiles(work_dir)
+                worker_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                with zipfile.ZipFile(zip_path, "w", compression) as zip_file:
+                    tiling_pyhist.append_tiles_to_zip(zip_file, slide_path.name, work_dir)
+                archive_seconds = time.perf_counter() - start
+
+                records.append({
+                    "benchmark": "archive",
+                    "mode": mode,
+                    "repeat": repeat,
+                    "tiles": tile_count,
+                    "tile_bytes": tile_bytes,
+                    "worker_seconds": worker_seconds,
+                    "archive_seconds": archive_seconds,
+                    "archive_bytes": zip_path.stat().st_size,
+                })
+                shutil.rmtree(work_dir)
+                zip_path.unlink()
+    return records
+
+
+def write_tiff_directory(
+    tiff_file: BinaryIO, tags: List[Tuple[int, int, List[int]]]
+) -> int:
+    """Write a TIFF directory at the end of the file and return its offset.
+
+    Values that do not fit in an entry are written right after the directory.
+    The next-directory pointer is left at zero.
+    """
+    tiff_file.seek(0, 2)
+    offset = tiff_file.tell()
+    extra_offset = offset + 2 + 12 * len(tags) + 4
+    entries, extra = [], b""
+    for tag, value_type, values in sorted(tags):
+        code = "H" if value_type == TIFF_SHORT else "I"
+        data = struct.pack(f"<{len(values)}{code}", *values)
+        if len(data) <= 4:
+            entries.append(struct.pack("<HHI4s", tag, value_type, len(values), data.ljust(4, b"\0")))
+        else:
+            entries.append(struct.pack(
+                "<HHII", tag, value_type, len(values), extra_offset + len(extra)
+            ))
+            extra += data
+    tiff_file.write(struct.pack("<H", len(tags)) + b"".join(entries) + b"\0" * 4 + extra)
+    return offset
+
+
+def render_synthetic_tile(
+    layout: np.ndarray, x: int, y: int, downsample: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Render one tile of a synthetic H&E-like slide at level-0 origin (x, y)."""
+    offsets = np.arange(SYNTHETIC_TILE_SIZE) * downsample
+    rows = np.minimum((y + offsets) // SYNTHETIC_LAYOUT_SCALE, layout.shape[0] - 1)
+    cols = np.minimum((x + offsets) // SYNTHETIC_LAYOUT_SCALE, layout.shape[1] - 1)
+    tissue = layout[np.ix_(rows, cols)][..., None]
+    stain = np.array([200, 120, 180]) + rng.normal(0, 25, (SYNTHETIC_TILE_SIZE,) * 2 + (3,))
+    background = np.array([242, 242, 242]) + rng.normal(0, 2, (SYNTHETIC_TILE_SIZE,) * 2 + (3,))
+    return np.clip(np.where(tissue, stain, background), 0, 255).astype(np.uint8)
+
+
+def write_synthetic_slide(path: Path, width: int, height: int, seed: int = 0) -> Path:
+    """Write a pyramidal tiled TIFF of random tissue blobs that OpenSlide can open.
+
+    Levels are downsampled by ``SYNTHETIC_LEVEL_DOWNSAMPLE`` until the
+    smallest side falls below ``SYNTHETIC_MIN_LEVEL_SIZE``.
+    """
+    rng = np.random.default_rng(seed)
+    layout_rows = -(-height // SYNTHETIC_LAYOUT_SCALE)
+    layout_cols = -(-width // SYNTHETIC_LAYOUT_SCALE)
+    grid_y, grid_x = np.mgrid[:layout_rows, :layout_cols]
+    layout = np.zeros((layout_rows, layout_cols), dtype=bool)
+    for _ in range(max(1, layout_rows * layout_cols // 400)):
+        center_y, center_x = rng.uniform(0, layout_rows), rng.uniform(0, layout_cols)
+        radius = rng.uniform(1, max(2, min(layout_rows, layout_cols) / 6))
+        layout |= (grid_y - center_y) ** 2 + (grid_x - center_x) ** 2 <= radius ** 2
+
+    with open(path, "wb") as tiff_file:
+        tiff_file.write(b"II*\0" + b"\0" * 4)
+        next_pointer = 4
+        downsample = 1
+        while True:
+            level_width, level_height = width // downsample, height // downsample
+            offsets, counts = [], []
+            for y in range(0, level_height, SYNTHETIC_TILE_SIZE):
+                for x in range(0, level_width, SYNTHETIC_TILE_SIZE):
+                    tile = render_synthetic_tile(layout, x * downsample, y * downsample, downsample, rng)
+                    payload = zlib.compress(tile.tobytes(), 1)
+                    offsets.append(tiff_file.seek(0, 2))
+                    counts.append(len(payload))
+                    tiff_file.write(payload)
+            tags = [
+                (254, TIFF_LONG, [0 if downsample == 1 else 1]),
+                (256, TIFF_LONG, [level_width]),
+                (257, TIFF_LONG, [level_height]),
+                (258, TIFF_SHORT, [8, 8, 8]),
+                (259, TIFF_SHORT, [TIFF_DEFLATE]),
+                (262, TIFF_SHORT, [2]),
+                (277, TIFF_SHORT, [3]),
+                (284, TIFF_SHORT, [1]),
+                (322, TIFF_LONG, [SYNTHETIC_TILE_SIZE]),
+                (323, TIFF_LONG, [SYNTHETIC_TILE_SIZE]),
+                (324, TIFF_LONG, offsets),
+                (325, TIFF_LONG, counts),
+            ]
+            directory = write_tiff_directory(tiff_file, tags)
+            tiff_file.seek(next_pointer)
+            tiff_file.write(struct.pack("<I", directory))
+            next_pointer = directory + 2 + 12 * len(tags)
+
+            downsample *= SYNTHETIC_LEVEL_DOWNSAMPLE
+            if min(width, height) // downsample < SYNTHETIC_MIN_LEVEL_SIZE:
+                break
+    return path
+
+
+def parse_dimensions(value: str) -> Tuple[int, int]:
+    """Parse a synthetic slide size such as '20000x15000'."""
+    try:
+        width, height = (int(side) for side in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid slide size: {value}")
+    if width < SYNTHETIC_MIN_LEVEL_SIZE or height < SYNTHETIC_MIN_LEVEL_SIZE:
+        raise argparse.ArgumentTypeError(
+            f"Slide sides must be at least {SYNTHETIC_MIN_LEVEL_SIZE} pixels"
+        )
+    return width, height
+
+
+def parse_int_list(value: str) -> List[int]:
+    """Parse a comma-separated list of positive integers such as '1,2,4'."""
+    try:
+        values = sorted({int(item) for item in value.split(",")})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid integer list: {value}")
+    if values[0] < 1:
+        raise argparse.ArgumentTypeError("Values must be positive")
+    return values
+
+
+def run_with_peak_rss(command: List[str]) -> Tuple[float, int]:
+    """Run a command and return its wall time and peak resident memory.
+
+    Memory is the largest sampled sum of resident memory over the process
+    and all of its descendants.
+    """
+    start = time.perf_counter()
+    process = psutil.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    peak_rss = 0
+    while process.poll() is None:
+        try:
+            tree = [process] + process.children(recursive=True)
+            peak_rss = max(peak_rss, sum(child.memory_info().rss for child in tree))
+        except psutil.Error:
+            pass
+        time.sleep(RSS_POLL_SECONDS)
+    seconds = time.perf_counter() - start
+    stderr = process.stderr.read().decode(errors="replace")
+    if process.returncode:
+        raise RuntimeError(f"Tiler failed with exit code {process.returncode}:\n{stderr[-2000:]}")
+    return seconds, peak_rss
+
+
+def benchmark_tiling(args: argparse.Namespace) -> List[dict]:
+    """Time end-to-end tiling per engine and worker count, on real and synthetic slides."""
+    tiler = Path(tiling_pyhist.__file__)
+    copies = args.copies or max(args.workers)
+    records = []
+    with tempfile.TemporaryDirectory(prefix="tiler_bench_") as temp_dir_path:
+        temp_dir = Path(temp_dir_path)
+        slides = [Path(path) for path in args.slide]
+        for width, height in args.synthetic:
+            slides.append(write_synthetic_slide(temp_dir / f"synthetic_{width}x{height}.tiff", width, height))
+
+        for slide_path in slides:
+            with openslide.OpenSlide(str(slide_path)) as slide:
+                dimensions, level_count = slide.dimensions, slide.level_count
+            for engine in args.engines:
+                baseline = None
+                for workers in args.workers:
+                    run_records = []
+                    for repeat in range(args.repeats):
+                        output_zip = temp_dir / "tiles.zip"
+                        metrics_path = temp_dir / "metrics.json"
+                        command = [
+                            sys.executable, str(tiler),
+                            "--engine", engine,
+                            "--output_downsample", str(args.downsample),
+                            "--output_zip", str(output_zip),
+                            "--output_metrics", str(metrics_path),
+                            "--metrics_format", "json",
+                            "--max_workers", str(workers),
+                        ]
+                        for copy in range(copies):
+                            command += [
+                                "--input", str(slide_path),
+                                "--original_name", f"{slide_path.stem}_{copy}{slide_path.suffix}",
+                            ]
+                        seconds, peak_rss = run_with_peak_rss(command)
+                        tiles = sum(
+                            metrics.get("tiles", 0)
+                            for metrics in json.loads(metrics_path.read_text())
+                        )
+                        output_zip.unlink()
+                        run_records.append({
+                            "benchmark": "tiling",
+                            "slide": slide_path.name,
+                            "width": dimensions[0],
+                            "height": dimensions[1],
+                            "levels": level_count,
+                            "engine": engine,
+                            "workers": workers,
+                            "copies": copies,
+                            "repeat": repeat,
+                            "tiles": tiles,
+                            "seconds": seconds,
+                            "seconds_per_slide": seconds / copies,
+                            "tiles_per_second": tiles / seconds,
+                            "peak_rss_mb": peak_rss / 1024 ** 2,
+                        })
+
+                    if baseline is None:
+                        baseline = sum(record["seconds"] for record in run_records) / len(run_records)
+                    for record in run_records:
+                        record["speedup"] = baseline / record["seconds"]
+                    records.extend(run_records)
+    return records
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the Galaxy tiler")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    archive = subparsers.add_parser("archive", help="ZIP archiving time vs size")
+    archive.add_argument(
+        "--slide",
+        default=str(Path(__file__).parent / "test-data" / "CMU-1-Small-Region.svs"),
+        help="Slide to tile for the benchmark"
+    )
+    archive.add_argument(
+        "--downsample",
+        type=int,
+        default=1,
+        help="Output downsample used to produce the tiles"
+    )
+    archive.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Measurements per compression mode"
+    )
+    archive.add_argument(
+        "--output",
+        help="Optional JSON file for the benchmark records"
+    )
+    archive.set_defaults(run=benchmark_archive)
+
+    tiling = subparsers.add_parser("tiling", help="Tiling throughput and worker scaling")
+    tiling.add_argument(
+        "--slide",
+        action="append",
+        help="Slide to tile; repeat for several (default: the test slide)"
+    )
+    tiling.add_argument(
+        "--synthetic",
+        action="append",
+        type=parse_dimensions,
+        default=[],
+        help="Also tile a synthetic pyramidal slide of this size, e.g. '20000x15000'; "
+             "repeat for several"
+    )
+    tiling.add_argument(
+        "--engines",
+        type=lambda value: value.split(","),
+        default=list(tiling_pyhist.TILING_ENGINES),
+        help="Comma-separated tiling engines to compare"
+    )
+    tiling.add_argument(
+        "--workers",
+        type=parse_int_list,
+        help="Comma-separated worker counts to run; the tiler caps them at the number of "
+             "physical cores (default: 1 to that number)"
+    )
+    tiling.add_argument(
+        "--copies",
+        type=int,
+        help="Inputs per run, each a copy of the slide (default: the largest worker count)"
+    )
+    tiling.add_argument(
+        "--downsample",
+        type=int,
+        default=tiling_pyhist.DEFAULT_DOWNSCALE_FACTOR,
+        help="Output downsample"
+    )
+    tiling.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Measurements per engine and worker count"
+    )
+    tiling.add_argument(
+        "--output",
+        help="Optional JSON file for the benchmark records"
+    )
+    tiling.set_defaults(run=benchmark_tiling)
+
+    args = parser.parse_args()
+    if args.benchmark == "tiling":
+        if not args.slide:
+            args.slide = [str(Path(__file__).parent / "test-data" / "CMU-1-Small-Region.svs")]
+        if not args.workers:
+            args.workers = list(range(1, tiling_pyhist.get_max_workers() + 1))
+    return args
+
+
+def main() -> None:
+    """Run the selected benchmark and report its records."""
+    args = parse_arguments()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    records = args.run(args)
+    for record in records:
+        print(json.dumps(record))
+    if args.output:
+        Path(args.output).write_text(json.dumps(records, indent=2))
+
+
+if __name__ == "__main__":
+    main()
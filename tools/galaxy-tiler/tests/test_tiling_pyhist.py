@@ -0,0 +1,88 @@
+"""Tests of the native OpenSlide tiling engine on the bundled test slide.
+
+Run from the tool directory with ``python -m pytest tests``, after
+installing ``tests/requirements.txt``; PyHIST is not needed.
+"""
+
+import importlib
+import sys
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+TOOL_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TOOL_DIR))
+tiling_pyhist = importlib.import_module("tiling_pyhist")
+tile_reader = importlib.import_module("tile_reader")
+
+TEST_SLIDE = TOOL_DIR / "test-data" / "CMU-1-Small-Region.svs"
+SHARD_SIZE = 5
+
+
+def tile_slide(output_dir: Path, band_workers: int, quality_filter: bool) -> Path:
+    settings = {
+        "engine": "openslide",
+        "band_workers": band_workers,
+        "zip_compression": "stored",
+        "output_format": "npy_shards",
+        "shard_size": SHARD_SIZE,
+        "read_threads": 2,
+        "cache_dir": None,
+        "output_downsamples": [1],
+        "quality_thresholds": {
+            "min_blur_score": tiling_pyhist.DEFAULT_MIN_BLUR_SCORE,
+            "max_background_fraction": tiling_pyhist.DEFAULT_MAX_BACKGROUND_FRACTION,
+            "max_pen_fraction": tiling_pyhist.DEFAULT_MAX_PEN_FRACTION,
+        } if quality_filter else None,
+        "stain_normalization": "none",
+    }
+    return tiling_pyhist.process_image_with_openslide(
+        TEST_SLIDE, output_dir, TEST_SLIDE.name, settings, {}
+    )
+
+
+def read_tile_dir(tile_dir: Path) -> dict:
+    return {path.name: path.read_bytes() for path in sorted(tile_dir.iterdir())}
+
+
+@pytest.mark.parametrize("quality_filter", [False, True])
+def test_shards_do_not_depend_on_band_workers(tmp_path: Path, quality_filter: bool) -> None:
+    single = tile_slide(tmp_path / "single", 1, quality_filter)
+    banded = tile_slide(tmp_path / "banded", 3, quality_filter)
+    assert read_tile_dir(single) == read_tile_dir(banded)
+
+
+def test_filtered_shards_are_full(tmp_path: Path) -> None:
+    tile_dir = tile_slide(tmp_path, 3, quality_filter=True)
+    index = pd.read_csv(tile_dir / tiling_pyhist.SHARD_INDEX, sep="\t")
+    scores = pd.read_csv(tile_dir / tiling_pyhist.QUALITY_SCORES, sep="\t")
+    assert 0 < len(index) < len(scores)
+    assert not list(tile_dir.glob(f"{tiling_pyhist.PARTIAL_SHARD_PREFIX}*"))
+
+    shards = sorted(tile_dir.glob("shard_*.npy"))
+    sizes = [len(np.load(shard, mmap_mode="r")) for shard in shards]
+    assert sizes[:-1] == [SHARD_SIZE] * (len(shards) - 1)
+    assert sum(sizes) == len(index)
+    assert list(index["tile_number"]) == sorted(index["tile_number"])
+    assert list(index["shard"]) == [
+        f"shard_{row // SHARD_SIZE:05d}.npy" for row in range(len(index))
+    ]
+
+
+def test_shard_reader_maps_archived_shards(tmp_path: Path) -> None:
+    tile_dir = tile_slide(tmp_path, 1, quality_filter=False)
+    zip_path = tmp_path / "tiles.zip"
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        tiling_pyhist.append_shards_to_zip(zip_file, TEST_SLIDE.name, tile_dir)
+    expected = np.concatenate([np.load(path) for path in sorted(tile_dir.glob("shard_*.npy"))])
+
+    with tile_reader.TileShardReader(str(zip_path)) as reader:
+        assert len(reader) == len(expected)
+        assert set(reader.index["slide"]) == {TEST_SLIDE.stem}
+        batches = list(reader.iter_batches(batch_size=SHARD_SIZE + 2))
+        assert isinstance(reader.get_shard(reader.index["shard"][0]), np.memmap)
+
+    assert np.array_equal(np.concatenate([tiles for _, tiles in batches]), expected)
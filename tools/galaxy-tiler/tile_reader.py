@@ -0,0 +1,180 @@
+"""
+Readers for the tile manifests and NPY tile shards written by ``tiling_pyhist.py``.
+
+A manifest holds one row per tile (slide, downsample, tile_number, level, x,
+y, size, patch_size, tissue_fraction) instead of the tile pixels. This module reads
+the pixels back from the original slides on demand with OpenSlide, in
+batches, so consumers only pay for the tiles they actually use.
+
+Usage:
+  from tile_reader import TileManifestReader
+
+  with TileManifestReader("tiles.parquet", {"sample1": "sample1.svs"}) as reader:
+      for rows, tiles in reader.iter_batches(batch_size=64):
+          ...  # rows: manifest rows, tiles: (N, 256, 256, 3) uint8 array
+
+Shard archives (``--output_format npy_shards``) store every shard
+uncompressed, so ``TileShardReader`` memory-maps the shards in place inside
+the ZIP file, without extracting them, and reads only the tiles asked for:
+
+  from tile_reader import TileShardReader
+
+  with TileShardReader("tiles.zip") as reader:
+      for rows, tiles in reader.iter_batches(batch_size=64):
+          ...  # rows: index rows, tiles: (N, 256, 256, 3) uint8 array
+"""
+
+import struct
+import zipfile
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import openslide
+import pandas as pd
+from PIL import Image
+
+SHARD_INDEX = "index.tsv"
+# Fixed part of a ZIP local file header; the name and extra field lengths
+# are its last two 16-bit fields
+LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+
+
+class TileManifestReader:
+    """Read manifest tiles from their slides as uint8 RGB arrays."""
+
+    def __init__(self, manifest_path: str, slide_paths: Dict[str, str]):
+        self.manifest = pd.read_parquet(manifest_path)
+        missing = set(self.manifest["slide"]) - set(slide_paths)
+        if missing:
+            raise ValueError(f"No slide path given for: {sorted(missing)}")
+        self.slide_paths = slide_paths
+        self._slides = {}
+
+    def __len__(self) -> int:
+        return len(self.manifest)
+
+    def __enter__(self) -> "TileManifestReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close every slide opened so far."""
+        for slide in self._slides.values():
+            slide.close()
+        self._slides.clear()
+
+    def _get_slide(self, name: str) -> openslide.OpenSlide:
+        if name not in self._slides:
+            self._slides[name] = openslide.OpenSlide(str(self.slide_paths[name]))
+        return self._slides[name]
+
+    def read_tile(self, row: pd.Series) -> np.ndarray:
+        """Read the tile described by one manifest row."""
+        slide = self._get_slide(row["slide"])
+        region = slide.read_region(
+            (int(row["x"]), int(row["y"])), int(row["level"]), (int(row["size"]),) * 2
+        )
+        tile = Image.new("RGB", region.size, (255, 255, 255))
+        tile.paste(region, mask=region.getchannel("A"))
+        patch_size = int(row["patch_size"])
+        if tile.size != (patch_size, patch_size):
+            tile = tile.resize((patch_size, patch_size), Image.BILINEAR)
+        return np.asarray(tile)
+
+    def iter_batches(
+        self,
+        batch_size: int = 64,
+        slides: Optional[Iterable[str]] = None,
+        min_tissue_fraction: float = 0.0,
+        downsample: Optional[int] = None
+    ) -> Iterator[Tuple[pd.DataFrame, np.ndarray]]:
+        """Yield manifest rows with their tiles stacked as an (N, size, size, 3) array.
+
+        ``slides``, ``min_tissue_fraction`` and ``downsample`` restrict which
+        tiles are read.
+        """
+        selected = self.manifest[self.manifest["tissue_fraction"] >= min_tissue_fraction]
+        if slides is not None:
+            selected = selected[selected["slide"].isin(list(slides))]
+        if downsample is not None:
+            selected = selected[selected["downsample"] == downsample]
+
+        for start in range(0, len(selected), batch_size):
+            rows = selected.iloc[start:start + batch_size]
+            yield rows, np.stack([self.read_tile(row) for _, row in rows.iterrows()])
+
+
+class TileShardReader:
+    """Read tiles from the NPY shards of a tile archive as uint8 RGB arrays."""
+
+    def __init__(self, zip_path: str):
+        self.zip_path = zip_path
+        with zipfile.ZipFile(zip_path) as archive:
+            self._members = {info.filename: info for info in archive.infolist()}
+            indexes = [
+                pd.read_csv(archive.open(name), sep="\t", dtype={"slide": str})
+                for name in self._members if name.endswith(SHARD_INDEX)
+            ]
+        if not indexes:
+            raise ValueError(f"No tile shard index in {zip_path}")
+        self.index = pd.concat(indexes, ignore_index=True)
+        self._shards = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __enter__(self) -> "TileShardReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Drop every shard mapped so far."""
+        self._shards.clear()
+
+    def get_shard(self, name: str) -> np.ndarray:
+        """Memory-map one shard member of the archive as an (N, size, size, 3) array."""
+        if name not in self._shards:
+            info = self._members[name]
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Shard {name} is compressed and cannot be memory-mapped")
+            with open(self.zip_path, "rb") as archive:
+                archive.seek(info.header_offset)
+                header = LOCAL_HEADER.unpack(archive.read(LOCAL_HEADER.size))
+                archive.seek(info.header_offset + LOCAL_HEADER.size + header[-2] + header[-1])
+                if np.lib.format.read_magic(archive) == (1, 0):
+                    read_header = np.lib.format.read_array_header_1_0
+                else:
+                    read_header = np.lib.format.read_array_header_2_0
+                shape, fortran_order, dtype = read_header(archive)
+                offset = archive.tell()
+            self._shards[name] = np.memmap(
+                self.zip_path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                order="F" if fortran_order else "C"
+            )
+        return self._shards[name]
+
+    def read_tile(self, row: pd.Series) -> np.ndarray:
+        """Read the tile described by one index row."""
+        return np.array(self.get_shard(row["shard"])[int(row["row"])])
+
+    def iter_batches(
+        self,
+        batch_size: int = 64,
+        slides: Optional[Iterable[str]] = None,
+        min_tissue_fraction: float = 0.0
+    ) -> Iterator[Tuple[pd.DataFrame, np.ndarray]]:
+        """Yield index rows with their tiles stacked as an (N, size, size, 3) array.
+
+        ``slides`` and ``min_tissue_fraction`` restrict which tiles are read.
+        """
+        selected = self.index[self.index["tissue_fraction"] >= min_tissue_fraction]
+        if slides is not None:
+            selected = selected[selected["slide"].isin(list(slides))]
+
+        for start in range(0, len(selected), batch_size):
+            rows = selected.iloc[start:start + batch_size]
+            yield rows, np.stack([self.read_tile(row) for _, row in rows.iterrows()])
@@ -1,18 +1,29 @@
 import argparse
+import csv
+import hashlib
+import json
 import logging
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import zipfile
-from concurrent.futures import ProcessPoolExecutor
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager, ExitStack
+from itertools import islice
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import openslide
+import pandas as pd
 import psutil
-from pyhist import PySlide, TileGenerator
-from src import utility_functions
+from PIL import Image
 
 # Configure logging to stdout
 logging.basicConfig(
@@ -26,7 +37,67 @@ SEGMENT_BINARY_PATH = "/pyhist/src/graph_segmentation/segment"
 DEFAULT_PATCH_SIZE = 256
 DEFAULT_DOWNSCALE_FACTOR = 8
 TILE_FORMAT = "png"
-MEMORY_PER_WORKER = 1  # GB, estimated memory per worker process
+MEMORY_PER_WORKER = 1  # GB, baseline memory of a slide worker process
+BAND_WORKER_MEMORY = 0.25  # GB, baseline memory of a band process
+WORKING_IMAGE_COPIES = 4  # copies of the segmentation image alive at peak
+MEMORY_HEADROOM = 0.9  # fraction of available memory the scheduler may use
+SCHEDULER_POLL_SECONDS = 5  # re-check the memory budget while slides wait
+PIPELINE_DEPTH = 2  # finished slides allowed to wait for the ZIP writer
+NATIVE_MASK_DOWNSAMPLE = 32  # slide downsample used by the native tissue mask
+TILE_BANDS_PER_WORKER = 4  # bands per band worker, to balance uneven tissue
+TILE_BATCH_SIZE = 32  # tiles read, scored and written together
+DEFAULT_READ_THREADS = 4  # region reads in flight per worker; OpenSlide releases the GIL
+READ_PREFETCH_BATCHES = 2  # batches read ahead of the one being written
+RSS_SAMPLE_SECONDS = 0.1  # interval of the per-slide peak memory sampling
+ZIP_COMPRESSION_MODES = {
+    "deflated": zipfile.ZIP_DEFLATED,
+    "stored": zipfile.ZIP_STORED,
+    "parallel": zipfile.ZIP_DEFLATED,  # deflated by the slide workers
+}
+PRECOMPRESSED_SUFFIX = ".deflate"
+PRECOMPRESSED_INDEX = "precompressed.json"
+OUTPUT_FORMATS = ("png", "npy_shards", "manifest")
+DEFAULT_SHARD_SIZE = 256  # tiles per NPY shard
+SHARD_INDEX = "index.tsv"
+PARTIAL_SHARD_PREFIX = "partial_"  # band-local shards of filtered tiles, repacked per slide
+SLIDE_MANIFEST = "manifest.tsv"
+SCALE_DIR_PREFIX = "ds"  # per-downsample tile directories when tiling several
+QUALITY_SCORES = "quality.tsv"
+QUALITY_FIELDS = [
+    "tile_number", "x", "y", "tissue_fraction", "blur_score", "background_fraction",
+    "pen_fraction", "kept",
+]
+DEFAULT_MIN_BLUR_SCORE = 15.0  # variance of the grayscale Laplacian
+DEFAULT_MAX_BACKGROUND_FRACTION = 0.85
+DEFAULT_MAX_PEN_FRACTION = 0.05
+BACKGROUND_MIN_VALUE = 0.85  # brightness from which unsaturated pixels are background
+BACKGROUND_MAX_SATURATION = 0.1
+PEN_MIN_SATURATION = 0.3
+PEN_MIN_GREEN_EXCESS = 0.1  # green above red, as a fraction of full scale
+STAIN_NORMALIZATION_METHODS = ("none", "macenko", "reinhard")
+STAIN_FIT_MAX_PIXELS = 200_000  # overview tissue pixels sampled to fit a slide
+STAIN_FIT_MIN_PIXELS = 100
+MACENKO_MIN_OPTICAL_DENSITY = 0.15  # transparent pixels left out of the stain fit
+MACENKO_ANGLE_PERCENTILE = 1
+# Reference H&E stain vectors and 99th percentile concentrations (Macenko et al. 2009)
+MACENKO_REFERENCE_STAINS = [[0.5626, 0.2159], [0.7201, 0.8012], [0.4062, 0.5581]]
+MACENKO_REFERENCE_MAX_CONCENTRATIONS = [1.9705, 1.0308]
+# Reference l-alpha-beta statistics of a well-stained H&E slide (Reinhard et al. 2001)
+REINHARD_REFERENCE_MEAN = [8.63234435, -0.11501964, 0.03868433]
+REINHARD_REFERENCE_STD = [0.57506023, 0.10403329, 0.01364062]
+RGB_TO_LMS = np.array([[0.3811, 0.5783, 0.0402], [0.1967, 0.7244, 0.0782], [0.0241, 0.1288, 0.8444]])
+LMS_TO_LAB = np.diag([3 ** -0.5, 6 ** -0.5, 2 ** -0.5]) @ np.array([[1, 1, 1], [1, 1, -2], [1, -1, 0]])
+CACHE_HASH_CHUNK = 8 * 1024 * 1024  # bytes read at a time when hashing slides
+CACHE_KEY_SETTINGS = (
+    "engine", "output_format", "shard_size", "zip_compression", "output_downsamples",
+    "quality_thresholds", "stain_normalization",
+)
+METRICS_FIELDS = [
+    "slide", "engine", "cached", "tiles", "rejected_tiles", "validation_seconds", "mask_seconds",
+    "stain_fit_seconds", "extraction_seconds", "compression_seconds", "archiving_seconds",
+    "worker_seconds", "tiles_per_second", "scratch_bytes", "archived_bytes",
+    "worker_pid", "worker_start_rss_mb", "worker_peak_rss_mb", "band_peak_rss_mb",
+]
 
 
 def log_memory_usage() -> None:
@@ -40,6 +111,53 @@ def log_memory_usage() -> None:
     )
 
 
+@contextmanager
+def timed_stage(metrics: dict, stage: str) -> Iterator[None]:
+    """Add the wall time of the enclosed block to ``metrics["<stage>_seconds"]``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        key = f"{stage}_seconds"
+        metrics[key] = metrics.get(key, 0.0) + time.perf_counter() - start
+
+
+@contextmanager
+def sampled_peak_rss(metrics: dict) -> Iterator[None]:
+    """Record the peak resident memory of this process and, combined, of its
+    child processes while the enclosed block runs.
+
+    Memory is sampled from a thread, as the peak of the process lifetime
+    reported by ``getrusage`` would carry over between the slides that a
+    pooled worker processes. The resident memory at the start is recorded
+    too, since memory retained from earlier slides counts towards the peak.
+    """
+    process = psutil.Process()
+    metrics["worker_start_rss_mb"] = process.memory_info().rss / 1024 ** 2
+    peaks = {"worker": 0, "band": 0}
+    stop = threading.Event()
+
+    def sample() -> None:
+        while True:
+            try:
+                peaks["worker"] = max(peaks["worker"], process.memory_info().rss)
+            except psutil.Error:
+                pass
+            peaks["band"] = max(peaks["band"], get_worker_rss())
+            if stop.wait(RSS_SAMPLE_SECONDS):
+                break
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        sampler.join()
+        metrics["worker_peak_rss_mb"] = peaks["worker"] / 1024 ** 2
+        metrics["band_peak_rss_mb"] = peaks["band"] / 1024 ** 2
+
+
 def validate_slide(image_path: Path) -> None:
     """Validate the input image using OpenSlide."""
     try:
@@ -58,14 +176,16 @@ def check_segmentation_binary() -> bool:
     return False
 
 
-def build_pyhist_config(image_path: Path, output_dir: Path) -> dict:
+def build_pyhist_config(
+    image_path: Path, output_dir: Path, output_downsample: int = DEFAULT_DOWNSCALE_FACTOR
+) -> dict:
     """Build the configuration dictionary for PyHIST processing."""
     return {
         "svs": str(image_path),
         "patch_size": DEFAULT_PATCH_SIZE,
         "method": "otsu",
         "thres": 0.1,
-        "output_downsample": DEFAULT_DOWNSCALE_FACTOR,
+        "output_downsample": output_downsample,
         "mask_downsample": DEFAULT_DOWNSCALE_FACTOR,
         "borders": "0000",
         "corners": "1010",
@@ -85,20 +205,29 @@ def build_pyhist_config(image_path: Path, output_dir: Path) -> dict:
 
 
 def process_image_with_pyhist(
-    image_path: Path, output_dir: Path, original_name: str
+    image_path: Path, output_dir: Path, original_name: str, settings: dict, metrics: dict
 ) -> Path:
-    """Process a single image with PyHIST and return the tile directory."""
+    """Process a single image with PyHIST and return the tile directory.
+
+    PyHIST segments and extracts in one call, so its mask time is part of
+    the extraction stage in ``metrics``.
+    """
+    # PyHIST is only installed in the container, and only this engine needs it
+    from pyhist import PySlide, TileGenerator
+    from src import utility_functions
+
     logging.info("Processing image: %s", image_path)
     log_memory_usage()
 
-    # Validate input
-    validate_slide(image_path)
+    with timed_stage(metrics, "validation"):
+        # Validate input
+        validate_slide(image_path)
 
-    # Check segmentation method
-    check_segmentation_binary()
+        # Check segmentation method
+        check_segmentation_binary()
 
     # Prepare PyHIST configuration
-    config = build_pyhist_config(image_path, output_dir)
+    config = build_pyhist_config(image_path, output_dir, settings["output_downsamples"][0])
 
     # Set logging level based on config
     log_levels = {
@@ -109,65 +238,907 @@ def process_image_with_pyhist(
     logging.getLogger().setLevel(log_levels[config["info"]])
 
     # Process the slide
-    utility_functions.check_image(config["svs"])
-    slide = PySlide(config)
-    logging.info("Slide loaded: %s", slide)
+    with timed_stage(metrics, "validation"):
+        utility_functions.check_image(config["svs"])
 
-    tile_generator = TileGenerator(slide)
-    logging.info("Tile generator initialized: %s", tile_generator)
+    with timed_stage(metrics, "extraction"):
+        slide = PySlide(config)
+        logging.info("Slide loaded: %s", slide)
 
-    try:
-        tile_generator.execute()
-    except subprocess.CalledProcessError as error:
-        raise RuntimeError("Tile extraction failed: %s", error) from error
+        tile_generator = TileGenerator(slide)
+        logging.info("Tile generator initialized: %s", tile_generator)
+
+        try:
+            tile_generator.execute()
+        except subprocess.CalledProcessError as error:
+            raise RuntimeError("Tile extraction failed: %s", error) from error
 
     tile_dir = Path(slide.tile_folder)
     tiles = list(tile_dir.glob(f"*.{TILE_FORMAT}"))
+    metrics["tiles"] = len(tiles)
     logging.info("Found %d tiles in %s", len(tiles), tile_dir)
 
     utility_functions.clean(slide)
     return tile_dir
 
 
+def region_to_rgb(region: Image.Image) -> Image.Image:
+    """Flatten an RGBA OpenSlide region onto a white background."""
+    background = Image.new("RGB", region.size, (255, 255, 255))
+    background.paste(region, mask=region.getchannel("A"))
+    return background
+
+
+def compute_otsu_threshold(gray: np.ndarray) -> int:
+    """Return the Otsu threshold of an 8-bit grayscale image."""
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight_below = np.cumsum(histogram)
+    weight_above = weight_below[-1] - weight_below
+    cumulative_sum = np.cumsum(histogram * np.arange(256))
+    mean_below = cumulative_sum / np.maximum(weight_below, 1)
+    mean_above = (cumulative_sum[-1] - cumulative_sum) / np.maximum(weight_above, 1)
+    between_variance = weight_below * weight_above * (mean_below - mean_above) ** 2
+    return int(np.argmax(between_variance))
+
+
+def read_tissue_overview(
+    slide: openslide.OpenSlide
+) -> Tuple[Image.Image, Image.Image, int, float]:
+    """Read the overview that tissue is segmented on.
+
+    Returns the RGB and grayscale overview from the pyramid level closest to
+    ``NATIVE_MASK_DOWNSAMPLE``, the Otsu threshold of the grayscale one and
+    its downsample.
+    """
+    level = slide.get_best_level_for_downsample(NATIVE_MASK_DOWNSAMPLE)
+    rgb_overview = region_to_rgb(slide.read_region((0, 0), level, slide.level_dimensions[level]))
+    overview = rgb_overview.convert("L")
+    threshold = compute_otsu_threshold(np.asarray(overview))
+    return rgb_overview, overview, threshold, slide.level_downsamples[level]
+
+
+def plan_tissue_tiles(
+    slide: openslide.OpenSlide,
+    config: dict,
+    overview: Optional[Tuple[Image.Image, Image.Image, int, float]] = None
+) -> List[Tuple[int, int, int, float]]:
+    """Return (tile_number, x, y, tissue_fraction) for every tile to extract.
+
+    Tissue is segmented with Otsu on a low-resolution pyramid level; pass
+    the result of ``read_tissue_overview`` to plan several downsamples from
+    one segmentation. Tiles cover ``patch_size * output_downsample`` level-0
+    pixels, are numbered row-major over the full grid and partial tiles at
+    the borders are dropped, as PyHIST does with ``save_nonsquare`` disabled.
+    Grids of every downsample start at the slide origin, so tiles of
+    downsamples that divide each other are nested.
+    """
+    footprint = config["patch_size"] * config["output_downsample"]
+    columns = slide.dimensions[0] // footprint
+    rows = slide.dimensions[1] // footprint
+    if not columns or not rows:
+        return []
+
+    if overview is None:
+        overview = read_tissue_overview(slide)
+    _, overview_image, threshold, level_downsample = overview
+
+    # Resample the overview so that each tile maps onto a cell x cell block
+    cell = max(1, footprint // NATIVE_MASK_DOWNSAMPLE)
+    grid_box = (
+        0, 0, columns * footprint / level_downsample, rows * footprint / level_downsample
+    )
+    grid = np.asarray(overview_image.resize((columns * cell, rows * cell), box=grid_box))
+    tissue = (grid <= threshold).reshape(rows, cell, columns, cell).mean(axis=(1, 3))
+
+    return [
+        (int(row * columns + column), int(column * footprint), int(row * footprint),
+         float(tissue[row, column]))
+        for row, column in zip(*np.nonzero(tissue >= config["thres"]))
+    ]
+
+
+def get_tile_level(slide: openslide.OpenSlide, config: dict) -> Tuple[int, int]:
+    """Return the pyramid level tiles are read from and the region size at that level."""
+    level = slide.get_best_level_for_downsample(config["output_downsample"])
+    size = round(
+        config["patch_size"] * config["output_downsample"] / slide.level_downsamples[level]
+    )
+    return level, size
+
+
+def read_tile(
+    slide: openslide.OpenSlide, x: int, y: int, config: dict
+) -> Image.Image:
+    """Read one output tile from the pyramid level closest to the output downsample."""
+    patch_size = config["patch_size"]
+    level, size = get_tile_level(slide, config)
+    tile = region_to_rgb(slide.read_region((x, y), level, (size, size)))
+    if tile.size != (patch_size, patch_size):
+        tile = tile.resize((patch_size, patch_size), Image.BILINEAR)
+    return tile
+
+
+def iter_tile_batches(
+    slide: openslide.OpenSlide,
+    tiles: List[Tuple[int, int, int, float]],
+    config: dict,
+    read_threads: int
+) -> Iterator[Tuple[List[Tuple[int, int, int, float]], np.ndarray]]:
+    """Yield consecutive batches of tiles with their pixels as an (N, size, size, 3) array.
+
+    Region reads are issued from a pool of ``read_threads`` threads sharing
+    the slide handle, and the next ``READ_PREFETCH_BATCHES`` batches are read
+    while the caller processes the current one, so slow storage is not
+    waited on one tile at a time.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=read_threads) as executor:
+        def submit(start: int) -> None:
+            batch_tiles = tiles[start:start + TILE_BATCH_SIZE]
+            pending.append((batch_tiles, [
+                executor.submit(read_tile, slide, x, y, config) for _, x, y, _ in batch_tiles
+            ]))
+
+        starts = iter(range(0, len(tiles), TILE_BATCH_SIZE))
+        for start in islice(starts, READ_PREFETCH_BATCHES + 1):
+            submit(start)
+        while pending:
+            batch_tiles, reads = pending.popleft()
+            next_start = next(starts, None)
+            if next_start is not None:
+                submit(next_start)
+            yield batch_tiles, np.stack([np.asarray(read.result()) for read in reads])
+
+
+def split_into_bands(
+    tiles: List[Tuple[int, int, int, float]], band_count: int, alignment: int = 1
+) -> List[Tuple[int, List[Tuple[int, int, int, float]]]]:
+    """Split row-major tiles into at most ``band_count`` contiguous bands of similar size.
+
+    Each band is returned with the index of its first tile, and bands start
+    at multiples of ``alignment`` so they never share an NPY shard.
+    """
+    chunk_count = -(-len(tiles) // alignment)
+    band_count = max(1, min(band_count, chunk_count))
+    bounds = np.linspace(0, chunk_count, band_count + 1).astype(int) * alignment
+    bounds = np.minimum(bounds, len(tiles))
+    return [(start, tiles[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def score_tile_quality(batch: np.ndarray) -> Dict[str, np.ndarray]:
+    """Score a batch of (N, size, size, 3) uint8 RGB tiles.
+
+    Returns, per tile, the variance of the grayscale Laplacian (low for
+    out-of-focus tiles), the fraction of bright unsaturated background
+    pixels, and the fraction of saturated pixels whose green exceeds their
+    red. H&E stains absorb green, so the last one picks up green and blue
+    marker ink.
+    """
+    pixels = batch.astype(np.float32) / 255
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+
+    gray = (0.299 * red + 0.587 * green + 0.114 * blue) * 255
+    laplacian = (
+        gray[:, :-2, 1:-1] + gray[:, 2:, 1:-1] + gray[:, 1:-1, :-2] + gray[:, 1:-1, 2:]
+        - 4 * gray[:, 1:-1, 1:-1]
+    )
+
+    value = pixels.max(axis=-1)
+    saturation = (value - pixels.min(axis=-1)) / np.maximum(value, 1e-6)
+    background = (value >= BACKGROUND_MIN_VALUE) & (saturation <= BACKGROUND_MAX_SATURATION)
+    pen = (saturation >= PEN_MIN_SATURATION) & (green - red >= PEN_MIN_GREEN_EXCESS)
+
+    return {
+        "blur_score": laplacian.var(axis=(1, 2)),
+        "background_fraction": background.mean(axis=(1, 2)),
+        "pen_fraction": pen.mean(axis=(1, 2)),
+    }
+
+
+def passes_quality(scores: Dict[str, np.ndarray], thresholds: dict) -> np.ndarray:
+    """Return which tiles of a scored batch meet the quality thresholds."""
+    return (
+        (scores["blur_score"] >= thresholds["min_blur_score"])
+        & (scores["background_fraction"] <= thresholds["max_background_fraction"])
+        & (scores["pen_fraction"] <= thresholds["max_pen_fraction"])
+    )
+
+
+def rgb_to_optical_density(pixels: np.ndarray) -> np.ndarray:
+    """Convert uint8 RGB values to optical density."""
+    return -np.log((pixels.astype(np.float32) + 1) / 256)
+
+
+def rgb_to_lab(pixels: np.ndarray) -> np.ndarray:
+    """Convert (..., 3) RGB values to Ruderman's l-alpha-beta space."""
+    lms = pixels.astype(np.float32) @ RGB_TO_LMS.T.astype(np.float32)
+    return np.log(np.maximum(lms, np.finfo(np.float32).eps)) @ LMS_TO_LAB.T.astype(np.float32)
+
+
+def lab_to_rgb(lab: np.ndarray) -> np.ndarray:
+    """Convert (..., 3) l-alpha-beta values back to uint8 RGB."""
+    lms = np.exp(lab @ np.linalg.inv(LMS_TO_LAB).T.astype(np.float32))
+    rgb = lms @ np.linalg.inv(RGB_TO_LMS).T.astype(np.float32)
+    return np.clip(rgb, 0, 255).astype(np.uint8)
+
+
+def fit_stain_normalization(
+    overview: Tuple[Image.Image, Image.Image, int, float], method: str
+) -> Optional[dict]:
+    """Fit a slide's stain normalization parameters from its tissue pixels.
+
+    Pixels are taken from the tissue of the overview returned by
+    ``read_tissue_overview``, the same the tissue mask is computed on.
+    Returns None, leaving tiles unnormalized, if the slide shows too little
+    tissue to fit.
+    """
+    rgb_overview, gray_overview, threshold, _ = overview
+    pixels = np.asarray(rgb_overview)[np.asarray(gray_overview) <= threshold]
+    if len(pixels) > STAIN_FIT_MAX_PIXELS:
+        pixels = np.random.default_rng(0).choice(pixels, STAIN_FIT_MAX_PIXELS, replace=False)
+
+    if method == "reinhard":
+        lab = rgb_to_lab(pixels)
+        if len(lab) < STAIN_FIT_MIN_PIXELS:
+            return None
+        return {
+            "method": method,
+            "mean": lab.mean(axis=0).tolist(),
+            "std": np.maximum(lab.std(axis=0), 1e-6).tolist(),
+        }
+
+    optical_density = rgb_to_optical_density(pixels)
+    optical_density = optical_density[(optical_density > MACENKO_MIN_OPTICAL_DENSITY).all(axis=1)]
+    if len(optical_density) < STAIN_FIT_MIN_PIXELS:
+        return None
+
+    # Stain vectors are the extreme angles of the optical densities projected
+    # on the plane of their two main directions; hematoxylin is the redder one
+    _, eigenvectors = np.linalg.eigh(np.cov(optical_density.T))
+    plane = eigenvectors[:, 1:3]
+    projected = optical_density @ plane
+    angles = np.arctan2(projected[:, 1], projected[:, 0])
+    stains = [
+        plane @ np.array([np.cos(angle), np.sin(angle)])
+        for angle in np.percentile(angles, [MACENKO_ANGLE_PERCENTILE, 100 - MACENKO_ANGLE_PERCENTILE])
+    ]
+    stains = [stain if stain.sum() >= 0 else -stain for stain in stains]
+    stains.sort(key=lambda stain: stain[0], reverse=True)
+    stain_matrix = np.stack(stains, axis=1)
+
+    concentrations = optical_density @ np.linalg.pinv(stain_matrix).T
+    return {
+        "method": method,
+        "stain_matrix": stain_matrix.tolist(),
+        "max_concentrations": np.maximum(np.percentile(concentrations, 99, axis=0), 1e-6).tolist(),
+    }
+
+
+def normalize_stains(batch: np.ndarray, parameters: dict) -> np.ndarray:
+    """Normalize a batch of uint8 RGB tiles to the reference stain appearance."""
+    if parameters["method"] == "reinhard":
+        lab = rgb_to_lab(batch)
+        scale = np.float32(REINHARD_REFERENCE_STD) / np.float32(parameters["std"])
+        shift = np.float32(REINHARD_REFERENCE_MEAN) - np.float32(parameters["mean"]) * scale
+        return lab_to_rgb(lab * scale + shift)
+
+    # Unmix into per-stain concentrations, rescale them to the reference
+    # range and remix them with the reference stain vectors
+    unmix = np.linalg.pinv(np.array(parameters["stain_matrix"])).T
+    scale = np.array(MACENKO_REFERENCE_MAX_CONCENTRATIONS) / np.array(parameters["max_concentrations"])
+    remix = (unmix * scale) @ np.array(MACENKO_REFERENCE_STAINS).T
+    optical_density = rgb_to_optical_density(batch) @ remix.astype(np.float32)
+    return np.clip(256 * np.exp(-optical_density) - 1, 0, 255).astype(np.uint8)
+
+
+def extract_tile_band(
+    task: Tuple[Path, Path, dict, dict, int, List[Tuple[int, int, int, float]]]
+) -> List[dict]:
+    """Extract one band of tiles with its own OpenSlide handle.
+
+    Tiles are read in prefetched batches and, when quality thresholds are
+    set, scored and filtered before they are encoded. Kept tiles are then
+    stain-normalized with the slide's fitted parameters, if any. PNG output writes one file per
+    kept tile. NPY output stacks kept tiles into uint8 shards of up to
+    ``shard_size`` tiles, numbered from the band's ``first_index`` in the
+    slide's tile list. When tiles are filtered, bands keep an unpredictable
+    number of tiles, so they write band-local partial shards instead, which
+    ``pack_filtered_shards`` repacks. Returns one record per tile with its
+    scores, whether it was kept and, for NPY output, where it was stored.
+    """
+    image_path, tile_dir, config, settings, first_index, tiles = task
+    patch_size = config["patch_size"]
+    shard_size = settings["shard_size"]
+    thresholds = settings["quality_thresholds"]
+    stain_parameters = config.get("stain_parameters")
+    to_shards = settings["output_format"] == "npy_shards"
+
+    records = []
+    shard = np.empty((shard_size, patch_size, patch_size, 3), np.uint8) if to_shards else None
+    shard_number = 0 if thresholds is not None else first_index // shard_size
+    shard_rows = 0
+
+    def shard_name(number: int) -> str:
+        if thresholds is not None:
+            return f"{PARTIAL_SHARD_PREFIX}{first_index:09d}_{number:05d}.npy"
+        return f"shard_{number:05d}.npy"
+
+    with openslide.OpenSlide(str(image_path)) as slide:
+        batches = iter_tile_batches(slide, tiles, config, settings["read_threads"])
+        for batch_tiles, batch in batches:
+            if thresholds is None:
+                scores = {}
+                keep = np.ones(len(batch_tiles), dtype=bool)
+            else:
+                scores = score_tile_quality(batch)
+                keep = passes_quality(scores, thresholds)
+            if stain_parameters is not None and keep.any():
+                batch[keep] = normalize_stains(batch[keep], stain_parameters)
+
+            for position, (tile_number, x, y, tissue_fraction) in enumerate(batch_tiles):
+                record = {
+                    "tile_number": tile_number, "x": x, "y": y,
+                    "tissue_fraction": tissue_fraction, "kept": bool(keep[position]),
+                }
+                record.update({name: float(values[position]) for name, values in scores.items()})
+                records.append(record)
+                if not record["kept"]:
+                    continue
+                if to_shards:
+                    shard[shard_rows] = batch[position]
+                    record["shard"] = shard_name(shard_number)
+                    record["row"] = shard_rows
+                    shard_rows += 1
+                    if shard_rows == shard_size:
+                        np.save(tile_dir / record["shard"], shard)
+                        shard_number += 1
+                        shard_rows = 0
+                else:
+                    Image.fromarray(batch[position]).save(
+                        tile_dir / f"{image_path.stem}_{tile_number}.{TILE_FORMAT}"
+                    )
+
+    if to_shards and shard_rows:
+        np.save(tile_dir / shard_name(shard_number), shard[:shard_rows])
+    return records
+
+
+def pack_filtered_shards(tile_dir: Path, records: List[dict], shard_size: int) -> None:
+    """Repack the partial shards of filtered bands into full shards in tile order.
+
+    Every shard but the last then holds ``shard_size`` tiles, whatever the
+    band partitioning. Records are updated with the final shard and row,
+    and each partial shard is removed once its tiles are copied.
+    """
+    shard = None
+    shard_number = 0
+    shard_rows = 0
+    partial_name = None
+    partial = None
+    for record in records:
+        if not record["kept"]:
+            continue
+        if record["shard"] != partial_name:
+            if partial_name is not None:
+                del partial
+                os.remove(tile_dir / partial_name)
+            partial_name = record["shard"]
+            partial = np.load(tile_dir / partial_name, mmap_mode="r")
+        if shard is None:
+            shard = np.empty((shard_size,) + partial.shape[1:], np.uint8)
+        shard[shard_rows] = partial[record["row"]]
+        record["shard"] = f"shard_{shard_number:05d}.npy"
+        record["row"] = shard_rows
+        shard_rows += 1
+        if shard_rows == shard_size:
+            np.save(tile_dir / record["shard"], shard)
+            shard_number += 1
+            shard_rows = 0
+    if partial_name is not None:
+        del partial
+        os.remove(tile_dir / partial_name)
+    if shard_rows:
+        np.save(tile_dir / f"shard_{shard_number:05d}.npy", shard[:shard_rows])
+
+
+def write_shard_index(tile_dir: Path, records: List[dict]) -> None:
+    """Write the TSV that locates every kept tile of a slide within its NPY shards.
+
+    Shards are referenced by file name; ``append_shards_to_zip`` adds the
+    slide name and archive member names when the slide is archived.
+    """
+    with open(tile_dir / SHARD_INDEX, "w", newline="") as index_file:
+        writer = csv.writer(index_file, delimiter="\t")
+        writer.writerow(["shard", "row", "tile_number", "x", "y", "tissue_fraction"])
+        for record in records:
+            if record["kept"]:
+                writer.writerow([
+                    record["shard"], record["row"], record["tile_number"], record["x"],
+                    record["y"], f"{record['tissue_fraction']:.4f}"
+                ])
+
+
+def write_quality_scores(tile_dir: Path, records: List[dict]) -> None:
+    """Write the quality scores and filter decision of every tile of a slide."""
+    with open(tile_dir / QUALITY_SCORES, "w", newline="") as scores_file:
+        writer = csv.DictWriter(
+            scores_file, fieldnames=QUALITY_FIELDS, delimiter="\t", extrasaction="ignore"
+        )
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def write_slide_manifest(
+    tile_dir: Path,
+    plans: List[Tuple[int, dict, List[Tuple[int, int, int, float]], int, int, Path]],
+    patch_size: int
+) -> None:
+    """Write the coordinates from which every tile of a slide can be read back."""
+    with open(tile_dir / SLIDE_MANIFEST, "w", newline="") as manifest_file:
+        writer = csv.writer(manifest_file, delimiter="\t")
+        writer.writerow([
+            "downsample", "tile_number", "level", "x", "y", "size", "patch_size",
+            "tissue_fraction"
+        ])
+        for downsample, _, tiles, level, size, _ in plans:
+            for tile_number, x, y, tissue_fraction in tiles:
+                writer.writerow([
+                    downsample, tile_number, level, x, y, size, patch_size,
+                    f"{tissue_fraction:.4f}"
+                ])
+
+
+def process_image_with_openslide(
+    image_path: Path, output_dir: Path, original_name: str, settings: dict, metrics: dict
+) -> Path:
+    """Tile a single image in-process with OpenSlide and return the tile directory.
+
+    Tissue is segmented once and tiles are planned for every requested
+    output downsample, each read from its closest pyramid level. With more
+    than one downsample, each tile set goes to its own ``ds<downsample>``
+    subdirectory. With ``band_workers`` above one, the tile grids are split
+    into row bands that are extracted by separate processes. Tile numbers
+    come from the grid position, so the output does not depend on the
+    partitioning.
+    """
+    logging.info("Processing image natively: %s", image_path)
+    log_memory_usage()
+
+    with timed_stage(metrics, "validation"):
+        validate_slide(image_path)
+    config = build_pyhist_config(image_path, output_dir)
+
+    tile_dir = output_dir / f"{image_path.stem}_tiles"
+    tile_dir.mkdir(parents=True, exist_ok=True)
+
+    downsamples = settings["output_downsamples"]
+    plans = []
+    with openslide.OpenSlide(str(image_path)) as slide:
+        with timed_stage(metrics, "mask"):
+            overview = read_tissue_overview(slide)
+        if settings["stain_normalization"] != "none":
+            with timed_stage(metrics, "stain_fit"):
+                config["stain_parameters"] = fit_stain_normalization(
+                    overview, settings["stain_normalization"]
+                )
+            if config["stain_parameters"] is None:
+                logging.warning("Too little tissue to fit stain normalization: %s", image_path)
+            else:
+                logging.info("Stain normalization parameters: %s", config["stain_parameters"])
+        with timed_stage(metrics, "mask"):
+            for downsample in downsamples:
+                scale_config = dict(config, output_downsample=downsample)
+                level, size = get_tile_level(slide, scale_config)
+                tiles = plan_tissue_tiles(slide, scale_config, overview)
+                scale_dir = tile_dir / f"{SCALE_DIR_PREFIX}{downsample}" if len(downsamples) > 1 else tile_dir
+                plans.append((downsample, scale_config, tiles, level, size, scale_dir))
+    metrics["tiles"] = sum(len(tiles) for _, _, tiles, _, _, _ in plans)
+
+    if settings["output_format"] == "manifest":
+        write_slide_manifest(tile_dir, plans, config["patch_size"])
+        logging.info("Planned %d tiles into %s", metrics["tiles"], tile_dir)
+        return tile_dir
+
+    band_workers = settings["band_workers"]
+    alignment = settings["shard_size"] if settings["output_format"] == "npy_shards" else 1
+    band_tasks = []
+    for _, scale_config, tiles, _, _, scale_dir in plans:
+        scale_dir.mkdir(exist_ok=True)
+        band_tasks.extend(
+            (image_path, scale_dir, scale_config, settings, first_index, band)
+            for first_index, band in split_into_bands(
+                tiles, band_workers * TILE_BANDS_PER_WORKER, alignment
+            )
+        )
+    with timed_stage(metrics, "extraction"):
+        if band_workers > 1 and len(band_tasks) > 1:
+            logging.info(
+                "Extracting %d tile bands with %d processes", len(band_tasks), band_workers
+            )
+            with ProcessPoolExecutor(max_workers=band_workers) as executor:
+                band_records = list(executor.map(extract_tile_band, band_tasks))
+        else:
+            band_records = list(map(extract_tile_band, band_tasks))
+
+        scale_records = {scale_dir: [] for _, _, _, _, _, scale_dir in plans}
+        for band_task, records in zip(band_tasks, band_records):
+            scale_records[band_task[1]].extend(records)
+        for scale_dir, records in scale_records.items():
+            if settings["output_format"] == "npy_shards":
+                if settings["quality_thresholds"] is not None:
+                    pack_filtered_shards(scale_dir, records, settings["shard_size"])
+                write_shard_index(scale_dir, records)
+            if settings["quality_thresholds"] is not None:
+                write_quality_scores(scale_dir, records)
+
+    extracted = sum(record["kept"] for records in band_records for record in records)
+    metrics["rejected_tiles"] = metrics["tiles"] - extracted
+    metrics["tiles"] = extracted
+
+    logging.info(
+        "Extracted %d tiles at downsamples %s into %s", extracted, downsamples, tile_dir
+    )
+    return tile_dir
+
+
+TILING_ENGINES = {
+    "pyhist": process_image_with_pyhist,
+    "openslide": process_image_with_openslide,
+}
+
+
+def precompress_tiles(tile_dir: Path) -> None:
+    """Deflate every tile in place so the ZIP writer only has to copy bytes.
+
+    Each tile is replaced by its raw deflate stream, and the CRC and original
+    size needed for the ZIP headers are recorded in ``PRECOMPRESSED_INDEX``.
+    """
+    index = {}
+    for tile in tile_dir.glob(f"*.{TILE_FORMAT}"):
+        data = tile.read_bytes()
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+        tile.with_name(tile.name + PRECOMPRESSED_SUFFIX).write_bytes(payload)
+        index[tile.name] = [zlib.crc32(data), len(data)]
+        tile.unlink()
+    (tile_dir / PRECOMPRESSED_INDEX).write_text(json.dumps(index))
+
+
+def write_precompressed_entry(
+    zip_file: zipfile.ZipFile,
+    arcname: str,
+    payload: bytes,
+    crc: int,
+    file_size: int
+) -> None:
+    """Append an already deflated member to a ZIP file opened for writing.
+
+    zipfile has no public API for raw members, so this writes the local header
+    and payload and registers the entry the same way ZipFile.writestr does.
+    """
+    zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o644 << 16
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(payload)
+    zip64 = max(file_size, len(payload)) > zipfile.ZIP64_LIMIT
+
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    zip_file.fp.write(payload)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+    zip_file.start_dir = zip_file.fp.tell()
+    zip_file._didModify = True
+
+
+def list_scale_dirs(tile_dir: Path) -> List[Tuple[str, Path]]:
+    """Return the (scale, directory) pairs holding a slide's tiles.
+
+    Slides tiled at a single downsample have one unnamed scale: the tile
+    directory itself.
+    """
+    scale_dirs = sorted(
+        (path for path in tile_dir.glob(f"{SCALE_DIR_PREFIX}*") if path.is_dir()),
+        key=lambda path: int(path.name[len(SCALE_DIR_PREFIX):])
+    )
+    if not scale_dirs:
+        return [("", tile_dir)]
+    return [(path.name, path) for path in scale_dirs]
+
+
+def get_archive_prefix(original_name: str, scale: str) -> str:
+    """Return the archive path prefix of a slide's tiles at one scale."""
+    original_base = Path(original_name).stem
+    if scale:
+        return f"{original_base}/{scale}/{original_base}_{scale}_"
+    return f"{original_base}/{original_base}_"
+
+
 def append_tiles_to_zip(
     zip_file: zipfile.ZipFile,
     original_name: str,
-    tile_dir: Path
+    tile_dir: Path,
+    scale: str = ""
 ) -> None:
-    """Append PNG tiles from the tile directory to the ZIP file."""
-    original_base = Path(original_name).stem
-    tiles = list(tile_dir.glob(f"*.{TILE_FORMAT}"))
+    """Append PNG tiles from the tile directory to the ZIP file.
+
+    Tiles deflated beforehand by ``precompress_tiles`` are copied as-is.
+    """
+    prefix = get_archive_prefix(original_name, scale)
+    index_path = tile_dir / PRECOMPRESSED_INDEX
+    precompressed = json.loads(index_path.read_text()) if index_path.exists() else None
+    if precompressed is None:
+        tiles = list(tile_dir.glob(f"*.{TILE_FORMAT}"))
+    else:
+        tiles = [tile_dir / name for name in precompressed]
 
     for tile in tiles:
         tile_number = tile.stem.split("_")[-1]
-        arcname = f"{original_base}/{original_base}_{tile_number}.{TILE_FORMAT}"
-        zip_file.write(tile, arcname)
+        arcname = f"{prefix}{tile_number}.{TILE_FORMAT}"
+        if precompressed is None:
+            zip_file.write(tile, arcname)
+        else:
+            payload = tile.with_name(tile.name + PRECOMPRESSED_SUFFIX).read_bytes()
+            crc, file_size = precompressed[tile.name]
+            write_precompressed_entry(zip_file, arcname, payload, crc, file_size)
 
     logging.info("Appended %d tiles from %s", len(tiles), tile_dir)
 
 
-def process_single_image(task: Tuple[Path, str, Path]) -> Path:
-    """Process a single image and return the tile directory."""
-    image_path, original_name, output_dir = task
+def append_shards_to_zip(
+    zip_file: zipfile.ZipFile,
+    original_name: str,
+    tile_dir: Path,
+    scale: str = ""
+) -> None:
+    """Append NPY tile shards and their index to the ZIP file.
+
+    Shards are always stored uncompressed so that readers can memory-map
+    them straight out of the archive. The archived index names the slide
+    and the shard members for every tile.
+    """
+    original_base = Path(original_name).stem
+    prefix = get_archive_prefix(original_name, scale)
+    shards = sorted(tile_dir.glob("shard_*.npy"))
+
+    for path in shards:
+        zip_file.write(path, f"{prefix}{path.name}", compress_type=zipfile.ZIP_STORED)
+
+    with open(tile_dir / SHARD_INDEX, newline="") as index_file:
+        rows = list(csv.reader(index_file, delimiter="\t"))
+    lines = ["\t".join(["slide"] + rows[0])]
+    for shard, *fields in rows[1:]:
+        lines.append("\t".join([original_base, f"{prefix}{shard}"] + fields))
+    zip_file.writestr(f"{prefix}{SHARD_INDEX}", "\n".join(lines) + "\n")
+
+    logging.info("Appended %d tile shards from %s", len(shards), tile_dir)
+
+
+def compute_cache_key(image_path: Path, settings: dict) -> str:
+    """Return the cache key of a slide: its content hash plus the tiling parameters.
+
+    Paths are left out of the parameters so that the same slide tiled under
+    another name or working directory maps to the same entry.
+    """
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as slide_file:
+        for chunk in iter(lambda: slide_file.read(CACHE_HASH_CHUNK), b""):
+            digest.update(chunk)
+
+    config = build_pyhist_config(image_path, Path())
+    parameters = {key: value for key, value in config.items() if key not in ("svs", "output")}
+    parameters.update({key: settings[key] for key in CACHE_KEY_SETTINGS})
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def store_in_cache(tile_dir: Path, cache_entry: Path) -> Path:
+    """Move a finished tile directory into the cache and return the entry.
+
+    The tiles are staged next to the entry and renamed into place, so an
+    entry only ever exists once complete and serves as the slide's
+    checkpoint if the job is interrupted later on.
+    """
+    staging = cache_entry.with_name(f"{cache_entry.name}.{os.getpid()}.tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    shutil.move(str(tile_dir), str(staging))
     try:
-        tile_dir = process_image_with_pyhist(
-            image_path,
-            output_dir,
-            original_name
-        )
-        return tile_dir
+        os.rename(staging, cache_entry)
+    except OSError:
+        # Another worker cached the same slide content first
+        shutil.rmtree(staging, ignore_errors=True)
+    return cache_entry
+
+
+def read_slide_manifest(original_name: str, tile_dir: Path) -> pd.DataFrame:
+    """Load a slide's tile coordinates, labelled with the slide name."""
+    manifest = pd.read_csv(tile_dir / SLIDE_MANIFEST, sep="\t")
+    manifest.insert(0, "slide", Path(original_name).stem)
+    return manifest
+
+
+def read_quality_scores(original_name: str, tile_dir: Path, scale: str = "") -> pd.DataFrame:
+    """Load the tile quality scores of one slide scale, labelled with slide and scale."""
+    scores = pd.read_csv(tile_dir / QUALITY_SCORES, sep="\t")
+    scores.insert(0, "slide", Path(original_name).stem)
+    scores.insert(1, "scale", scale)
+    return scores
+
+
+def record_worker_metrics(metrics: dict, tile_dir: Path) -> None:
+    """Add throughput and scratch size of the worker process to ``metrics``."""
+    extraction_seconds = metrics.get("extraction_seconds")
+    if extraction_seconds:
+        metrics["tiles_per_second"] = metrics.get("tiles", 0) / extraction_seconds
+    metrics["scratch_bytes"] = sum(
+        path.stat().st_size for path in tile_dir.rglob("*") if path.is_file()
+    )
+
+
+def process_single_image(task: Tuple[Path, str, Path, dict]) -> Tuple[Path, dict]:
+    """Process a single image and return the tile directory with its metrics.
+
+    With a cache directory, slides already tiled with the same content and
+    parameters are served from the cache, and newly tiled slides are added
+    to it. Cached directories are returned as-is and must not be deleted.
+    """
+    image_path, original_name, output_dir, settings = task
+    metrics = {
+        "slide": original_name,
+        "engine": settings["engine"],
+        "cached": False,
+        "worker_pid": os.getpid(),
+    }
+    try:
+        with timed_stage(metrics, "worker"), sampled_peak_rss(metrics):
+            cache_entry = None
+            if settings["cache_dir"]:
+                cache_entry = Path(settings["cache_dir"]) / compute_cache_key(image_path, settings)
+                if cache_entry.is_dir():
+                    logging.info("Reusing cached tiles for %s: %s", image_path, cache_entry)
+                    metrics["cached"] = True
+                    return cache_entry, metrics
+
+            tile_dir = TILING_ENGINES[settings["engine"]](
+                image_path,
+                output_dir,
+                original_name,
+                settings,
+                metrics
+            )
+            if settings["zip_compression"] == "parallel" and settings["output_format"] == "png":
+                with timed_stage(metrics, "compression"):
+                    for _, scale_dir in list_scale_dirs(tile_dir):
+                        precompress_tiles(scale_dir)
+            record_worker_metrics(metrics, tile_dir)
+            if cache_entry is not None:
+                tile_dir = store_in_cache(tile_dir, cache_entry)
+        return tile_dir, metrics
     except Exception as error:
         logging.error("Error processing %s: %s", image_path, error)
         raise
 
 
+def estimate_slide_cost(image_path: Path, settings: dict) -> Tuple[int, int]:
+    """Estimate the peak memory in bytes and the relative work of tiling a slide.
+
+    Memory is dominated by the low-resolution image each engine segments,
+    plus the baseline of the worker and band processes; work is the number
+    of level-0 pixels. Unreadable slides get the baseline so that the worker
+    reports the actual error.
+    """
+    memory = MEMORY_PER_WORKER * 1024 ** 3
+    if settings["engine"] == "openslide":
+        mask_downsample = NATIVE_MASK_DOWNSAMPLE
+        memory += settings["band_workers"] * BAND_WORKER_MEMORY * 1024 ** 3
+        if settings["output_format"] == "npy_shards":
+            patch_size = DEFAULT_PATCH_SIZE
+            memory += settings["band_workers"] * settings["shard_size"] * patch_size ** 2 * 3
+    else:
+        mask_downsample = DEFAULT_DOWNSCALE_FACTOR
+
+    try:
+        with openslide.OpenSlide(str(image_path)) as slide:
+            width, height = slide.dimensions
+            level = slide.get_best_level_for_downsample(mask_downsample)
+            level_width, level_height = slide.level_dimensions[level]
+    except openslide.OpenSlideError:
+        return int(memory), 0
+
+    memory += level_width * level_height * 4 * WORKING_IMAGE_COPIES
+    return int(memory), width * height
+
+
+def get_worker_rss() -> int:
+    """Return the combined resident memory of all child processes in bytes."""
+    total = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            continue
+    return total
+
+
+def fits_memory_budget(estimate: int, reserved: int) -> bool:
+    """Check a slide's memory estimate against the live memory budget.
+
+    ``reserved`` is the estimate of the slides already running. The part of
+    it not yet resident in the worker processes is taken off the memory that
+    psutil reports as available.
+    """
+    available = psutil.virtual_memory().available * MEMORY_HEADROOM
+    not_yet_resident = max(0, reserved - get_worker_rss())
+    return estimate <= available - not_yet_resident
+
+
+def iter_completed_slides(
+    executor: ProcessPoolExecutor,
+    tasks: List[Tuple[Path, str, Path, dict]],
+    memory_estimates: List[int],
+    max_in_flight: int
+) -> Iterator[Tuple[Tuple[Path, str, Path, dict], Tuple[Path, dict]]]:
+    """Yield each task with its tile directory and metrics as soon as the slide is tiled.
+
+    Tasks are admitted in the given order, skipping ahead to the first one
+    whose memory estimate fits the live budget; a slide is always admitted
+    when nothing else is running. At most ``max_in_flight`` slides are
+    submitted but not yet consumed, so the scratch space held by tiles
+    waiting to be archived stays bounded.
+    """
+    pending = deque(zip(tasks, memory_estimates))
+    in_flight = {}
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                reserved = sum(estimate for _, estimate in in_flight.values())
+                admissible = next(
+                    (
+                        position for position, (_, estimate) in enumerate(pending)
+                        if not in_flight or fits_memory_budget(estimate, reserved)
+                    ),
+                    None
+                )
+                if admissible is None:
+                    break
+                task, estimate = pending[admissible]
+                del pending[admissible]
+                in_flight[executor.submit(process_single_image, task)] = (task, estimate)
+
+            done, _ = wait(
+                in_flight,
+                timeout=SCHEDULER_POLL_SECONDS if pending else None,
+                return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                task, _ = in_flight.pop(future)
+                yield task, future.result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
 def get_max_workers() -> int:
-    """Determine the maximum number of worker processes based on available resources."""
-    cpu_cores = psutil.cpu_count(logical=False)  # Physical CPU cores
-    available_memory = psutil.virtual_memory().available / (1024 ** 3)  # in GB
-    max_workers_memory = available_memory // MEMORY_PER_WORKER
-    max_workers = min(cpu_cores, max_workers_memory)
-    return max(1, int(max_workers))
+    """Determine the maximum number of worker processes from the physical CPU cores.
+
+    Memory is not divided up front: ``iter_completed_slides`` admits slides
+    against the live memory budget instead.
+    """
+    cpu_cores = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    return max(1, cpu_cores)
+
+
+def parse_downsamples(value: str) -> List[int]:
+    """Parse a comma-separated list of output downsamples such as '8,16,32'."""
+    try:
+        downsamples = sorted({int(item) for item in value.split(",")})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid downsample list: {value}")
+    if downsamples[0] < 1:
+        raise argparse.ArgumentTypeError(f"Downsamples must be positive: {value}")
+    return downsamples
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -187,10 +1158,137 @@ def parse_arguments() -> argparse.Namespace:
     )
     parser.add_argument(
         "--output_zip",
-        required=True,
         help="Output ZIP file path"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--output_manifest",
+        help="Output Parquet manifest path for --output_format manifest"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=TILING_ENGINES.keys(),
+        default="pyhist",
+        help="Tiling engine: PyHIST segmentation or in-process OpenSlide tiling"
+    )
+    parser.add_argument(
+        "--output_downsample",
+        type=parse_downsamples,
+        default=[DEFAULT_DOWNSCALE_FACTOR],
+        help="Output downsample, or a comma-separated list to tile several "
+             "magnifications in one pass (e.g. '8,16,32')"
+    )
+    parser.add_argument(
+        "--zip_compression",
+        choices=ZIP_COMPRESSION_MODES.keys(),
+        default="deflated",
+        help="Deflate tiles while archiving, store them as-is, or deflate them in the worker processes"
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=OUTPUT_FORMATS,
+        default="png",
+        help="Archive one PNG per tile or uint8 NPY shards with a tile index, "
+             "or only write a Parquet manifest of tile coordinates"
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE,
+        help="Number of tiles per NPY shard"
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        help="Cap on tiling processes (default: one per physical CPU core)"
+    )
+    parser.add_argument(
+        "--read_threads",
+        type=int,
+        default=DEFAULT_READ_THREADS,
+        help="Threads issuing slide region reads in each OpenSlide tiling process; "
+             "raise on high-latency (e.g. network) storage"
+    )
+    parser.add_argument(
+        "--quality_filter",
+        action="store_true",
+        help="Drop blurry, background-only and pen-marked tiles before writing them"
+    )
+    parser.add_argument(
+        "--min_blur_score",
+        type=float,
+        default=DEFAULT_MIN_BLUR_SCORE,
+        help="Minimum variance of the grayscale Laplacian of a kept tile"
+    )
+    parser.add_argument(
+        "--max_background_fraction",
+        type=float,
+        default=DEFAULT_MAX_BACKGROUND_FRACTION,
+        help="Maximum fraction of bright, unsaturated background pixels in a kept tile"
+    )
+    parser.add_argument(
+        "--max_pen_fraction",
+        type=float,
+        default=DEFAULT_MAX_PEN_FRACTION,
+        help="Maximum fraction of pen-marked pixels in a kept tile"
+    )
+    parser.add_argument(
+        "--stain_normalization",
+        choices=STAIN_NORMALIZATION_METHODS,
+        default="none",
+        help="Normalize tile stains with parameters fitted once per slide from its tissue"
+    )
+    parser.add_argument(
+        "--output_quality",
+        help="Optional TSV of the quality scores and filter decision of every tile"
+    )
+    parser.add_argument(
+        "--output_metrics",
+        help="Optional per-slide performance metrics sidecar path"
+    )
+    parser.add_argument(
+        "--metrics_format",
+        choices=("tsv", "json"),
+        default="tsv",
+        help="Format of the metrics sidecar"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of tiles cached by slide content and tiling parameters; "
+             "reused slides are not tiled again"
+    )
+    args = parser.parse_args()
+    if args.output_format != "png" and args.engine != "openslide":
+        parser.error(f"--output_format {args.output_format} requires --engine openslide")
+    if len(args.output_downsample) > 1 and args.engine != "openslide":
+        parser.error("Several output downsamples require --engine openslide")
+    if args.output_format == "manifest" and not args.output_manifest:
+        parser.error("--output_format manifest requires --output_manifest")
+    if args.output_format != "manifest" and not args.output_zip:
+        parser.error("--output_zip is required")
+    if args.quality_filter and args.engine != "openslide":
+        parser.error("--quality_filter requires --engine openslide")
+    if args.quality_filter and args.output_format == "manifest":
+        parser.error("--quality_filter does not apply to --output_format manifest")
+    if args.stain_normalization != "none" and args.engine != "openslide":
+        parser.error("--stain_normalization requires --engine openslide")
+    if args.stain_normalization != "none" and args.output_format == "manifest":
+        parser.error("--stain_normalization does not apply to --output_format manifest")
+    if args.output_quality and not args.quality_filter:
+        parser.error("--output_quality requires --quality_filter")
+    return args
+
+
+def write_metrics(output_path: str, records: List[dict], metrics_format: str) -> None:
+    """Write the per-slide metrics as a TSV table or a JSON list."""
+    with open(output_path, "w", newline="") as metrics_file:
+        if metrics_format == "json":
+            json.dump(records, metrics_file, indent=2)
+        else:
+            writer = csv.DictWriter(
+                metrics_file, fieldnames=METRICS_FIELDS, delimiter="\t", restval=""
+            )
+            writer.writeheader()
+            writer.writerows(records)
 
 
 def main() -> None:
@@ -207,27 +1305,102 @@ def main() -> None:
     with tempfile.TemporaryDirectory(prefix="pyhist_tiles_", dir=os.getcwd()) as temp_dir_path:
         temp_dir = Path(temp_dir_path)
         logging.info("Created temporary directory: %s", temp_dir)
+        if args.cache_dir:
+            Path(args.cache_dir).mkdir(parents=True, exist_ok=True)
+            logging.info("Using tile cache: %s", args.cache_dir)
+
+        # Determine the number of worker processes based on available resources.
+        # Cores not needed for one process per slide split slides into bands.
+        max_workers = get_max_workers()
+        if args.max_workers:
+            max_workers = min(max_workers, args.max_workers)
+        slide_workers = max(1, min(max_workers, len(args.input)))
+        band_workers = max_workers // slide_workers if args.engine == "openslide" else 1
+        logging.info(
+            "Using %d slide worker processes with %d band processes each",
+            slide_workers, band_workers
+        )
+        settings = {
+            "engine": args.engine,
+            "band_workers": band_workers,
+            "zip_compression": args.zip_compression,
+            "output_format": args.output_format,
+            "shard_size": args.shard_size,
+            "read_threads": args.read_threads,
+            "cache_dir": args.cache_dir,
+            "output_downsamples": args.output_downsample,
+            "quality_thresholds": {
+                "min_blur_score": args.min_blur_score,
+                "max_background_fraction": args.max_background_fraction,
+                "max_pen_fraction": args.max_pen_fraction,
+            } if args.quality_filter else None,
+            "stain_normalization": args.stain_normalization,
+        }
 
-        # Prepare tasks with unique output directories
+        # Prepare tasks with unique output directories, largest slides first
+        # so that the longest jobs do not end up as stragglers
         tasks = [
-            (Path(image_path), original_name, temp_dir / Path(original_name).stem)
+            (Path(image_path), original_name, temp_dir / Path(original_name).stem, settings)
             for image_path, original_name in zip(args.input, args.original_name)
         ]
+        costs = [estimate_slide_cost(task[0], settings) for task in tasks]
+        order = sorted(range(len(tasks)), key=lambda index: costs[index][1], reverse=True)
+        tasks = [tasks[index] for index in order]
+        memory_estimates = [costs[index][0] for index in order]
 
-        # Determine the number of worker processes based on available resources
-        max_workers = get_max_workers()
-        logging.info("Using %d worker processes", max_workers)
+        # Process images in parallel and archive each slide as soon as it is
+        # tiled, removing its scratch tiles once they are in the ZIP
+        compression = ZIP_COMPRESSION_MODES[args.zip_compression]
+        manifests = []
+        quality_scores = []
+        metrics_records = []
+        with ProcessPoolExecutor(max_workers=slide_workers) as executor, \
+                ExitStack() as stack:
+            if args.output_format != "manifest":
+                zip_file = stack.enter_context(
+                    zipfile.ZipFile(args.output_zip, "w", compression)
+                )
+            completed = iter_completed_slides(
+                executor, tasks, memory_estimates, slide_workers + PIPELINE_DEPTH
+            )
+            for (image_path, original_name, output_dir, _), (tile_dir, metrics) in completed:
+                with timed_stage(metrics, "archiving"):
+                    if args.output_format == "manifest":
+                        manifests.append(read_slide_manifest(original_name, tile_dir))
+                    else:
+                        archive_start = zip_file.fp.tell()
+                        for scale, scale_dir in list_scale_dirs(tile_dir):
+                            if args.output_format == "npy_shards":
+                                append_shards_to_zip(zip_file, original_name, scale_dir, scale)
+                            else:
+                                append_tiles_to_zip(zip_file, original_name, scale_dir, scale)
+                        metrics["archived_bytes"] = zip_file.fp.tell() - archive_start
+                if args.output_quality:
+                    quality_scores.extend(
+                        read_quality_scores(original_name, scale_dir, scale)
+                        for scale, scale_dir in list_scale_dirs(tile_dir)
+                    )
+                shutil.rmtree(output_dir, ignore_errors=True)
+                metrics_records.append(metrics)
+                logging.info(
+                    "Slide %s: %d tiles in %.1f s", original_name,
+                    metrics.get("tiles", 0), metrics["worker_seconds"]
+                )
 
-        # Process images in parallel
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            tile_dirs = list(executor.map(process_single_image, tasks))
+        if args.output_format == "manifest":
+            manifest = pd.concat(manifests, ignore_index=True)
+            manifest.to_parquet(args.output_manifest, index=False)
+            logging.info("Wrote manifest of %d tiles: %s", len(manifest), args.output_manifest)
+        else:
+            logging.info("Final ZIP size: %d bytes", Path(args.output_zip).stat().st_size)
 
-        # Create the ZIP file and append all tiles
-        with zipfile.ZipFile(args.output_zip, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for (image_path, original_name, output_dir), tile_dir in zip(tasks, tile_dirs):
-                append_tiles_to_zip(zip_file, original_name, tile_dir)
+        if args.output_quality:
+            pd.concat(quality_scores, ignore_index=True).to_csv(
+                args.output_quality, sep="\t", index=False, float_format="%.4f"
+            )
 
-        logging.info("Final ZIP size: %d bytes", Path(args.output_zip).stat().st_size)
+        if args.output_metrics:
+            write_metrics(args.output_metrics, metrics_records, args.metrics_format)
     # No need for shutil.rmtree as TemporaryDirectory cleans up automatically
     logging.info("Temporary directory cleaned up")
 